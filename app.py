@@ -1,95 +1,375 @@
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import zipfile
+
 import streamlit as st
-import gzip
-from lxml import etree
 
-from expression_parser import parse_expression, resolve_variable_name_from_reference, parse_node_structured
-from drawio_exporter import generate_drawio_xml
+from background_export import ExportJob
+from diagnostics import Profile, stage
+from diagram_emitters import export_diagrams
+from layout import LevelOfDetail
+from process_pool import run_jobs
+from program_diff import CHANGED, DELETED, INSERTED, MOVED, diff_programs, format_diff, subtree_hashes
+from result_cache import DEFAULT_MAX_DISK_BYTES, DEFAULT_MAX_ENTRIES, ResultCache, content_key
+from text_renderer import PAGE_SIZE, render_program_text, render_section_page
+from urp_loader import load_urprogram
+from urp_pipeline import convert_program, convert_upload
 
 
 st.set_page_config(page_title="URProgram Visualizer", layout="wide")
 st.title("🤖 URProgram Visualizer")
 
-variable_element_to_name = {}
+PAGE_LINES = PAGE_SIZE
+SEARCH_RESULTS = 500
+# Overview diagram: three levels per section, long sequences and motion
+# runs folded into summary cells
+OVERVIEW_DETAIL = LevelOfDetail(max_depth=3, max_children=20, collapse_runs=True)
+
+
+@st.cache_resource
+def get_result_cache():
+    return ResultCache(
+        max_entries=int(os.environ.get("URP_CACHE_ENTRIES", DEFAULT_MAX_ENTRIES)),
+        disk_dir=os.environ.get("URP_CACHE_DIR") or None,
+        max_disk_bytes=int(os.environ.get("URP_CACHE_MAX_BYTES", DEFAULT_MAX_DISK_BYTES)),
+    )
+
+
+def load_result(uploaded_file, cache, profile=None):
+    """Conversion result for an upload, from the cache if possible; stops the
+    script with an error message if the file cannot be converted.
+
+    With a `profile`, a cached result converted without one is converted
+    again so every stage is measured."""
+    cache_key = content_key(uploaded_file.getvalue())
+    result, cache_source = cache.get(cache_key)
+    if result is not None and profile is not None and result.get("profile") is None:
+        result, cache_source = None, None
+
+    if result is None:
+        try:
+            with stage(profile, "load"):
+                root = load_urprogram(uploaded_file, profile=profile)
+        except Exception as e:
+            st.error(f"Reading .urp file failed: {e}")
+            st.stop()
+
+        if root is None:
+            st.error("Could not find <URProgram> block in the file.")
+            st.stop()
+
+        try:
+            result = convert_program(root, profile)
+        except Exception as e:
+            st.error(f"XML Parse Error: {e}")
+            st.stop()
+        if profile is not None:
+            result["profile"] = profile.to_dict()
+        cache.put(cache_key, result)
+    return result, cache_key, cache_source
+
+
+def program_hashes(result, cache, cache_key):
+    """Subtree hashes of a result's tree, computed once and cached with it,
+    so a diff only walks what changed."""
+    if result.get("hashes") is None:
+        result["hashes"] = subtree_hashes(result["structured_root"])
+        cache.put(cache_key, result)
+    return result["hashes"]
+
+
+def show_diagnostics(profile_data):
+    with st.expander("🩺 Diagnostics", expanded=True):
+        if profile_data is None:
+            st.info("This result was converted without diagnostics.")
+            return
+        st.table([
+            {"stage": name, "ms": round(record["seconds"] * 1000, 1), "peak MB": round(record.get("peak_bytes", 0) / (1024 * 1024), 2)}
+            for name, record in profile_data["stages"].items()
+        ])
+        st.json({"timers (s)": profile_data["timers"], "counters": profile_data["counters"]})
+        st.dataframe([
+            {"tag": tag, "count": data["count"], "ms": round(data["seconds"] * 1000, 2)}
+            for tag, data in profile_data["tags"].items()
+        ])
+        st.download_button("Download profile (JSON)", data=json.dumps(profile_data, indent=2), file_name="urprogram.profile.json", mime="application/json")
+
+
+def show_analysis(analysis):
+    with st.expander("🧭 Call graph and variables"):
+        for cycle in analysis.cycles():
+            st.warning("Recursive calls: " + " → ".join(cycle))
+        st.table([
+            {"caller": caller, "calls": ", ".join(callees)}
+            for caller, callees in analysis.call_graph().items()
+        ])
+        st.dataframe([
+            {
+                "variable": row["variable"],
+                "assigned": row["assigned"],
+                "read": row["read"],
+                "note": "never read" if not row["read"] else "never assigned" if not row["assigned"] else "",
+            }
+            for row in analysis.variable_table()
+        ])
+
 
+def start_drawio_export(result, cache_key):
+    """Start the draw.io export of `result` in the background, once per
+    session, and cancel the exports of files no longer shown."""
+    jobs = st.session_state.setdefault("drawio_jobs", {})
+    for key in [key for key in jobs if key != cache_key]:
+        jobs.pop(key).cancel()
+    if result["drawio"] is None and cache_key not in jobs:
+        # Compressed diagrams open the same in draw.io and download much faster
+        jobs[cache_key] = ExportJob(result["structured_root"], compressed=True, analysis=result.get("analysis")).start()
 
-def render_node_list(nodes, lines=None, line_counter=None, inside_init=False):
-    if lines is None:
-        lines = []
-    if line_counter is None:
-        line_counter = [1]  # Mutable line counter
 
-    for node in nodes:
-        if node is None:
+def drawio_download(result, cache, cache_key):
+    job = st.session_state.get("drawio_jobs", {}).get(cache_key)
+    if result["drawio"] is None and job is not None and job.finished:
+        if job.error is not None:
+            st.error(f"draw.io export failed: {job.error}")
+            return
+        result["drawio"] = job.result
+        if result.get("profile") is not None:
+            result["profile"]["stages"]["drawio"] = {"seconds": job.seconds}
+        cache.put(cache_key, result)
+
+    if result["drawio"] is not None:
+        st.download_button("💾 Download as draw.io XML", data=result["drawio"], file_name="urprogram.drawio", mime="application/xml")
+    elif job is not None:
+        drawio_export_progress(job)
+
+
+@st.fragment(run_every=1)
+def drawio_export_progress(job):
+    # Reruns every second on its own while the export runs, so the page is
+    # not blocked meanwhile. Once it is done, one rerun of the whole page
+    # shows the download, and this fragment (and its polling) is gone.
+    if job.finished:
+        st.rerun()
+    total = f" of {job.total_items}" if job.total_items else ""
+    st.progress(job.progress, text=f"Preparing draw.io export: {job.done_items}{total} cells")
+    st.download_button("💾 Download as draw.io XML", data=b"", disabled=True)
+
+
+def convert_uploads(uploaded_files, keys, cache):
+    """{content key: result or {"error": message}} for several uploads, with
+    the files not converted yet in this session decompressed, parsed and
+    exported on a process pool (see `process_pool.run_jobs`). The results
+    table is redrawn as each file finishes."""
+    results = st.session_state.setdefault("upload_results", {})
+    for key in [key for key in results if key not in keys]:
+        del results[key]
+
+    pending = {}
+    for uploaded_file, key in zip(uploaded_files, keys):
+        if key in results or key in pending:
             continue
+        cached, _ = cache.get(key)
+        if cached is not None and cached.get("stats") is not None:
+            results[key] = cached
+            continue
+        pending[key] = (uploaded_file.getvalue(),)
+
+    table = st.empty()
+    table.dataframe(upload_rows(uploaded_files, keys, results))
+    if not pending:
+        return results
+    progress = st.progress(0.0, text=f"Converting {len(pending)} files")
+    # spawn: Streamlit runs scripts on threads, which fork does not mix with
+    workers = int(os.environ.get("URP_WORKERS", 0)) or None
+    jobs = run_jobs(convert_upload, pending.items(), workers, multiprocessing.get_context("spawn"))
+    for done, (key, result, error) in enumerate(jobs, 1):
+        if isinstance(error, (RecursionError, pickle.PicklingError)):
+            # Too deep to be sent back from the worker; convert it here
+            try:
+                result, error = convert_upload(*pending[key]), None
+            except Exception as e:
+                error = e
+        if error is not None:
+            result = {"error": f"{type(error).__name__}: {error}"}
+        results[key] = result
+        if "error" not in result:
+            cache.put(key, result)
+        table.dataframe(upload_rows(uploaded_files, keys, results))
+        progress.progress(done / len(pending), text=f"Converted {done} of {len(pending)} files")
+    progress.empty()
+    return results
 
-        indent = "  " * node["depth"]
-        line_text = f"{indent}- {node['type']}: {node['displaytext']}"
 
-        if not inside_init:
-            line_prefix = f"{line_counter[0]:>3} | "
-            line_counter[0] += 1
+def upload_rows(uploaded_files, keys, results):
+    rows = []
+    for uploaded_file, key in zip(uploaded_files, keys):
+        result = results.get(key)
+        row = {"file": uploaded_file.name, "MB": round(uploaded_file.size / (1024 * 1024), 2)}
+        if result is None:
+            row["status"] = "converting…"
+        elif "error" in result:
+            row["status"] = result["error"]
         else:
-            line_prefix = "    | "
+            stats = result["stats"]
+            row.update({
+                "status": "ok",
+                "nodes": stats["nodes"],
+                "parse ms": round(stats["parse_seconds"] * 1000),
+                "export ms": round(stats["export_seconds"] * 1000),
+                "parser errors": len(stats["parser_errors"]),
+            })
+        rows.append(row)
+    return rows
+
 
-        lines.append(line_prefix + line_text)
+def show_upload_batch(uploaded_files, keys, results):
+    for uploaded_file, key in zip(uploaded_files, keys):
+        errors = results[key].get("stats", {}).get("parser_errors")
+        if errors:
+            with st.expander(f"⚠️ {uploaded_file.name}: {len(errors)} XML errors repaired or skipped"):
+                st.code("\n".join(errors), language="text")
 
-        # Recursively render children
-        # but pass `inside_init=True` if current node is InitVariablesNode
-        child_inside_init = inside_init or (node["type"] == "InitVariablesNode")
-        render_node_list(node["children"], lines, line_counter, inside_init=child_inside_init)
+    archive = st.session_state.get("upload_archive")
+    if (archive is None or archive[0] != keys) and st.button("Prepare zip of all exports"):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+            for uploaded_file, key in zip(uploaded_files, keys):
+                result = results[key]
+                if "error" not in result:
+                    stem = os.path.splitext(uploaded_file.name)[0]
+                    zf.writestr(f"{stem}.txt", result["text"])
+                    zf.writestr(f"{stem}.drawio", result["drawio"])
+        archive = st.session_state["upload_archive"] = (keys, buffer.getvalue())
 
-    return lines
+    if archive is not None and archive[0] == keys:
+        st.download_button("💾 Download all exports (zip)", data=archive[1], file_name="urprograms.zip", mime="application/zip")
 
 
+diagnostics_enabled = st.sidebar.toggle("Diagnostics", help="Re-convert uploads with per-stage timing, node counts per tag and reference resolution statistics")
+trace_memory = diagnostics_enabled and st.sidebar.toggle("Trace memory", help="Record each stage's peak Python memory; makes conversion several times slower")
 
+mode = st.radio("Mode", ["View a program", "Compare two revisions"], horizontal=True)
 
-uploaded_file = st.file_uploader("Upload a .urp file", type=["urp"])
+if mode == "Compare two revisions":
+    old_column, new_column = st.columns(2)
+    old_file = old_column.file_uploader("Old revision", type=["urp"])
+    new_file = new_column.file_uploader("New revision", type=["urp"])
+    if old_file and new_file:
+        cache = get_result_cache()
+        old_result, old_key, _ = load_result(old_file, cache)
+        new_result, new_key, _ = load_result(new_file, cache)
+        diff_key = f"diff-{old_key}-{new_key}"
+        changes, _ = cache.get(diff_key)
+        if changes is None:
+            changes = diff_programs(
+                old_result["structured_root"], new_result["structured_root"],
+                program_hashes(old_result, cache, old_key), program_hashes(new_result, cache, new_key),
+            )
+            cache.put(diff_key, changes)
+
+        st.subheader("🔀 Changes")
+        counts = st.columns(4)
+        for column, kind in zip(counts, (INSERTED, DELETED, MOVED, CHANGED)):
+            column.metric(kind.capitalize(), sum(1 for change in changes if change["kind"] == kind))
+        if changes:
+            st.code(format_diff(changes), language="diff")
+        else:
+            st.success("The programs are identical.")
+    st.stop()
+
+uploaded_files = st.file_uploader("Upload .urp files", type=["urp"], accept_multiple_files=True)
+uploaded_file = uploaded_files[0] if len(uploaded_files) == 1 else None
+
+if len(uploaded_files) > 1:
+    cache = get_result_cache()
+    upload_keys = [content_key(uploaded_file.getvalue()) for uploaded_file in uploaded_files]
+    upload_results = convert_uploads(uploaded_files, upload_keys, cache)
+    show_upload_batch(uploaded_files, upload_keys, upload_results)
+    converted = [position for position, key in enumerate(upload_keys) if "error" not in upload_results[key]]
+    choice = st.selectbox("Open a program", converted, index=None, format_func=lambda position: uploaded_files[position].name)
+    if choice is not None:
+        # Back into the cache, which may have evicted it while the rest converted
+        cache.put(upload_keys[choice], upload_results[upload_keys[choice]])
+        uploaded_file = uploaded_files[choice]
 
 if uploaded_file:
+    cache = get_result_cache()
+    profile = Profile(trace_memory) if diagnostics_enabled else None
+    result, cache_key, cache_source = load_result(uploaded_file, cache, profile)
 
-    try:
-        with gzip.open(uploaded_file, "rb") as f:
-            raw_bytes = f.read()
-        xml_text = raw_bytes.decode("utf-8", errors="ignore")
-    except Exception as e:
-        st.error(f"GZIP decompress failed: {e}")
-        st.stop()
-
-    start_tag = "<URProgram"
-    end_tag = "</URProgram>"
-    start_index = xml_text.find(start_tag)
-    end_index = xml_text.find(end_tag)
-    if start_index != -1 and end_index != -1:
-        end_index += len(end_tag)
-        xml_segment = xml_text[start_index:end_index]
+    st.caption(
+        f"Cache {cache_source or 'miss'} · {cache.hits} hits / {cache.misses} misses"
+        f" · sha256 {cache_key[:12]}"
+    )
 
-        try:
-            parser = etree.XMLParser(recover=True)
-            root = etree.fromstring(xml_segment.encode("utf-8"), parser=parser)
-            st.subheader("📜 Parsed Program Structure")
-            variable_element_to_name.clear()
-            structured_root = parse_node_structured(root, root)
+    start_drawio_export(result, cache_key)
 
-           # Skip top-level URProgram
-            top_children = structured_root["children"]
+    if diagnostics_enabled:
+        show_diagnostics(result.get("profile"))
 
-            all_lines = []
-            line_counter = [1]  # shared mutable counter across sections
+    query = st.text_input(
+        "🔎 Search", placeholder="variable:counter  subprogram:Pick  pin:digital_out[2]  tcp:Gripper  or words, e.g. waypoint_1*"
+    )
+    if query and result.get("index") is not None:
+        index = result["index"]
+        matches = index.search(query)
+        st.caption(f"{len(matches)} matching nodes" + (f", showing the first {SEARCH_RESULTS}" if len(matches) > SEARCH_RESULTS else ""))
+        st.dataframe([
+            {"type": index.nodes[node_id].type, "text": index.nodes[node_id].displaytext, "path": index.describe(node_id)}
+            for node_id in matches[:SEARCH_RESULTS]
+        ])
 
-            for section in top_children:
-                section_lines = render_node_list([section], line_counter=line_counter)
-                all_lines.extend(section_lines)
-                all_lines.append("")  # visual separation
+    if result.get("analysis") is not None:
+        show_analysis(result["analysis"])
 
-            final_output = "\n".join(all_lines)
-            st.code(final_output, language="text")
-                    
+    st.subheader("📜 Parsed Program Structure")
+    sections = result["sections"]
+    total_lines = sum(count for _, _, count in sections)
 
-            # drawio_data = generate_drawio_xml(structured_root)
-            # st.download_button("💾 Download as draw.io XML", data=drawio_data, file_name="urprogram.drawio", mime="application/xml")
+    # Jumping to a line only needs the precomputed section offsets
+    jump_to = st.number_input("Jump to line", min_value=0, max_value=total_lines, value=0, help="0 shows no jump")
+    max_depth = st.slider("Levels shown below each section", min_value=1, max_value=20, value=20)
 
+    for index, (section, first_line, count) in enumerate(sections):
+        jump_here = first_line <= jump_to < first_line + count
+        label = f"{section['type']}: {section['displaytext']} · lines {first_line}–{first_line + count - 1}"
+        # A section is only rendered once it is opened
+        if not st.toggle(label, value=jump_here, key=f"section-{cache_key}-{index}-{jump_to}"):
+            continue
+        pages = max(1, -(-count // PAGE_LINES))
+        page = (jump_to - first_line) // PAGE_LINES if jump_here else 0
+        if pages > 1:
+            page = st.number_input(
+                f"Page (of {pages})", min_value=1, max_value=pages, value=page + 1, key=f"page-{cache_key}-{index}-{jump_to}"
+            ) - 1
+        # Results cached before page checkpoints existed walk from the top
+        checkpoints = result.get("page_checkpoints")
+        lines = render_section_page(
+            section, first_line, page, PAGE_LINES, None if max_depth == 20 else max_depth, checkpoints[index] if checkpoints else None
+        )
+        st.code("\n".join(lines), language="text")
 
-        except Exception as e:
-            st.error(f"XML Parse Error: {e}")
-    else:
-        st.error("Could not find <URProgram> block in the file.")
+    if result["text"] is None and st.button("Prepare text download"):
+        result["text"] = render_program_text(result["structured_root"])
+        cache.put(cache_key, result)
+
+    if result["text"] is not None:
+        st.download_button("💾 Download as text", data=result["text"], file_name="urprogram.txt", mime="text/plain")
+
+    drawio_download(result, cache, cache_key)
+
+    if result.get("drawio_overview") is None and st.button("Prepare overview diagram", help="A draw.io diagram showing three levels per section, with the rest folded into summary cells"):
+        # Laid out once for both the draw.io download and the preview
+        overview = export_diagrams(result["structured_root"], ["drawio", "svg"], detail=OVERVIEW_DETAIL, compressed=True)
+        result["drawio_overview"] = overview["drawio"]
+        result["svg_overview"] = overview["svg"]
+        cache.put(cache_key, result)
+
+    if result.get("drawio_overview") is not None:
+        st.download_button("💾 Download overview as draw.io XML", data=result["drawio_overview"], file_name="urprogram-overview.drawio", mime="application/xml")
+        if result.get("svg_overview") is not None:
+            st.download_button("💾 Download overview as SVG", data=result["svg_overview"], file_name="urprogram-overview.svg", mime="image/svg+xml")
+            if st.toggle("Preview overview diagram"):
+                st.image(result["svg_overview"])
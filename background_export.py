@@ -0,0 +1,72 @@
+import threading
+import time
+
+from drawio_exporter import generate_drawio_pages, generate_drawio_xml
+
+
+class ExportCancelled(Exception):
+    """Raised inside a cancelled export to stop it between cells."""
+
+
+class ExportJob:
+    """A draw.io export generated on a daemon thread.
+
+    `options` are passed to `generate_drawio_xml`, or with `pages=True` to
+    `generate_drawio_pages`. The job reports how many cells (or pages) it
+    has written so far, and `cancel()` stops it at the next
+    progress report. Once finished, `result` holds the document or `error`
+    the exception that ended it.
+    """
+
+    def __init__(self, structured_root, pages=False, **options):
+        self.pages = pages
+        self.result = None
+        self.error = None
+        self.seconds = None
+        self.done_items = 0
+        self.total_items = None
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(structured_root, options), daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def finished(self):
+        return self._thread.ident is not None and not self._thread.is_alive()
+
+    @property
+    def progress(self):
+        """Share of the cells written, between 0 and 1."""
+        if not self.total_items:
+            return 1.0 if self.finished else 0.0
+        return min(1.0, self.done_items / self.total_items)
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+        return self.finished
+
+    def _run(self, structured_root, options):
+        started = time.perf_counter()
+        try:
+            generate = generate_drawio_pages if self.pages else generate_drawio_xml
+            self.result = generate(structured_root, progress=self._report, **options)
+        except ExportCancelled:
+            pass
+        except Exception as e:
+            self.error = e
+        self.seconds = time.perf_counter() - started
+
+    def _report(self, done, total):
+        if self._cancelled.is_set():
+            raise ExportCancelled()
+        self.done_items = done
+        self.total_items = total
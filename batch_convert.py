@@ -0,0 +1,245 @@
+"""Headless batch conversion of .urp files.
+
+Example:
+    python batch_convert.py backups/ "fleet/**/*.urp" -o out/ --format text drawio --workers 8
+"""
+import argparse
+import glob
+import json
+import os
+import signal
+import sys
+import time
+
+from diagnostics import Profile, stage
+from diagram_emitters import EMITTERS, DiagramModel
+from drawio_exporter import write_drawio_pages, write_drawio_xml
+from expression_parser import parse_node_structured
+from layout import LevelOfDetail, layout_program
+from process_pool import run_jobs
+from program_store import SIDECAR_SUFFIX, load_or_parse, write_program_tree
+from section_parser import parse_program_parallel
+from text_renderer import render_program_text
+from urp_loader import load_urprogram
+
+OUTPUT_SUFFIXES = {
+    "text": ".txt",
+    "drawio": ".drawio",
+    "json": ".json",
+    "tree": SIDECAR_SUFFIX,
+    "dot": ".dot",
+    "mermaid": ".mmd",
+    "svg": ".svg",
+}
+
+
+def collect_inputs(patterns):
+    """Expand directories (recursively), globs and plain paths into (path, relative name) pairs."""
+    inputs = []
+    seen = set()
+
+    def add(path, base):
+        path = os.path.abspath(path)
+        if path not in seen:
+            seen.add(path)
+            inputs.append((path, os.path.relpath(path, base)))
+
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for dirpath, _, filenames in os.walk(pattern):
+                for filename in sorted(filenames):
+                    if filename.lower().endswith(".urp"):
+                        add(os.path.join(dirpath, filename), pattern)
+        elif os.path.isfile(pattern):
+            add(pattern, os.path.dirname(pattern) or ".")
+        else:
+            base = _glob_base(pattern)
+            for path in sorted(glob.glob(pattern, recursive=True)):
+                if os.path.isfile(path):
+                    add(path, base)
+    return inputs
+
+
+def _glob_base(pattern):
+    # The leading directories of `pattern` without wildcards, which the
+    # relative names of its matches are taken against
+    parts = []
+    for part in pattern.replace(os.sep, "/").split("/")[:-1]:
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return "/".join(parts) or ("/" if pattern.startswith("/") else ".")
+
+
+def duplicate_outputs(inputs):
+    """{output name: input paths} for the output names (relative name
+    without extension) more than one input would write to."""
+    by_name = {}
+    for path, rel in inputs:
+        by_name.setdefault(os.path.normcase(os.path.splitext(rel)[0]), []).append(path)
+    return {name: paths for name, paths in by_name.items() if len(paths) > 1}
+
+
+def _raise_timeout(signum, frame):
+    raise TimeoutError("conversion timed out")
+
+
+def convert_file(path, output_base, formats, timeout=None, compress_drawio=False, write_profile=False, use_sidecars=False, drawio_pages=False, drawio_detail=None, section_workers=None):
+    """Convert one file; never raises, errors are reported in the returned dict.
+
+    With `write_profile`, a `diagnostics.Profile` of the conversion is
+    written next to the outputs as `<name>.profile.json`. With
+    `use_sidecars`, the parsed tree is read from (or written to) a binary
+    tree file next to the .urp, see `program_store.load_or_parse`. With
+    `drawio_pages`, the diagram gets one page per top-level section; a
+    `layout.LevelOfDetail` as `drawio_detail` makes it an overview. With
+    `section_workers`, the top-level sections are parsed on that many
+    processes (see `section_parser.parse_program_parallel`).
+    """
+    started = time.perf_counter()
+    result = {"path": path, "bytes": 0, "ok": False, "error": None, "outputs": []}
+
+    use_alarm = timeout and hasattr(signal, "setitimer")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        result["bytes"] = os.path.getsize(path)
+        profile = Profile() if write_profile else None
+        if use_sidecars:
+            with stage(profile, "load_tree"):
+                structured_root = load_or_parse(path)
+        else:
+            with stage(profile, "load"):
+                root = load_urprogram(path, profile=profile)
+            structured_root = None
+            if root is not None:
+                with stage(profile, "parse_structured"):
+                    if section_workers:
+                        structured_root = parse_program_parallel(root, section_workers)
+                    else:
+                        structured_root = parse_node_structured(root, root, profile=profile)
+        if structured_root is None:
+            raise ValueError("Could not find <URProgram> block in the file.")
+
+        os.makedirs(os.path.dirname(output_base) or ".", exist_ok=True)
+        # Laid out once for all diagram formats
+        layout = model = None
+        for fmt in formats:
+            out_path = output_base + OUTPUT_SUFFIXES[fmt]
+            if fmt == "tree":
+                with stage(profile, fmt):
+                    write_program_tree(structured_root, out_path, os.stat(path))
+                result["outputs"].append(out_path)
+                continue
+            with stage(profile, fmt), open(out_path, "w", encoding="utf-8") as f:
+                if (fmt in EMITTERS or fmt == "drawio" and not drawio_pages) and layout is None:
+                    layout = layout_program(structured_root, drawio_detail)
+                if fmt == "text":
+                    f.write(render_program_text(structured_root))
+                elif fmt == "drawio":
+                    if drawio_pages:
+                        # The batch already runs one file per worker process
+                        write_drawio_pages(structured_root, f, compressed=compress_drawio, workers=1, detail=drawio_detail)
+                    else:
+                        write_drawio_xml(structured_root, f, compressed=compress_drawio, layout=layout)
+                elif fmt in EMITTERS:
+                    if model is None:
+                        model = DiagramModel(layout)
+                    EMITTERS[fmt](model, f)
+                else:
+                    f.write(json.dumps(structured_root.to_dict()))
+            result["outputs"].append(out_path)
+        if profile is not None:
+            profile.write_json(output_base + ".profile.json")
+            result["outputs"].append(output_base + ".profile.json")
+        result["ok"] = True
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+
+def run_batch(inputs, output_dir, formats, workers=None, timeout=None, progress=None, compress_drawio=False, write_profile=False, use_sidecars=False, drawio_pages=False, drawio_detail=None, section_workers=None):
+    """Convert `inputs` on a process pool and return the per-file results.
+
+    A file whose worker dies outright (e.g. out of memory) is reported as
+    crashed; the files converting next to it are retried (see
+    `process_pool.run_jobs`). Raises ValueError if two inputs would write
+    the same outputs."""
+    duplicates = duplicate_outputs(inputs)
+    if duplicates:
+        name, paths = next(iter(duplicates.items()))
+        raise ValueError(f"{len(paths)} inputs would be written to {name}: {', '.join(paths)}")
+    results = []
+    jobs = [
+        (path, (path, os.path.join(output_dir, os.path.splitext(rel)[0]), formats, timeout, compress_drawio, write_profile, use_sidecars, drawio_pages, drawio_detail, section_workers))
+        for path, rel in inputs
+    ]
+    for path, result, error in run_jobs(convert_file, jobs, workers):
+        if error is not None:
+            result = {"path": path, "bytes": 0, "ok": False, "error": f"worker crashed: {error}", "outputs": [], "seconds": 0.0}
+        results.append(result)
+        if progress:
+            progress(result)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert .urp robot programs to text, diagrams (draw.io, DOT, Mermaid, SVG), JSON or binary trees.")
+    parser.add_argument("inputs", nargs="+", help="Files, directories (searched recursively) or glob patterns")
+    parser.add_argument("-o", "--output-dir", default="converted", help="Directory for the converted files")
+    parser.add_argument("-f", "--format", nargs="+", choices=sorted(OUTPUT_SUFFIXES), default=["text"], help="Output formats")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--section-workers", type=int, default=None, help="Parse the sections of each file on this many processes; for a few very large files")
+    parser.add_argument("-t", "--timeout", type=float, default=None, help="Per-file timeout in seconds")
+    parser.add_argument("--compress-drawio", action="store_true", help="Write draw.io diagrams in draw.io's compressed format")
+    parser.add_argument("--drawio-pages", action="store_true", help="Draw each top-level section on its own draw.io page, with links between pages")
+    parser.add_argument("--max-depth", type=int, default=None, help="Draw at most this many levels below each section; deeper nodes are folded into summary cells")
+    parser.add_argument("--max-children", type=int, default=None, help="Draw at most this many children per node; the rest are folded into a summary cell")
+    parser.add_argument("--collapse-runs", action="store_true", help="Fold runs of Move/Waypoint and InitVariable nodes into summary cells")
+    parser.add_argument("--sidecars", action="store_true", help=f"Reuse parsed trees stored next to the inputs as <file>{SIDECAR_SUFFIX}, writing them when missing or stale")
+    parser.add_argument("--profile", action="store_true", help="Write a JSON timing profile next to each converted file")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only print failures and the summary")
+    args = parser.parse_args(argv)
+
+    inputs = collect_inputs(args.inputs)
+    if not inputs:
+        print("No .urp files found.", file=sys.stderr)
+        return 1
+    duplicates = duplicate_outputs(inputs)
+    if duplicates:
+        for name, paths in duplicates.items():
+            print(f"Inputs with the same output name {name}: {', '.join(paths)}", file=sys.stderr)
+        print("Convert them in separate runs or from a common parent directory.", file=sys.stderr)
+        return 1
+
+    def progress(result):
+        if not result["ok"]:
+            print(f"FAILED {result['path']}: {result['error']}", file=sys.stderr)
+        elif not args.quiet:
+            print(f"ok     {result['path']} ({result['seconds']:.2f}s)")
+
+    detail = None
+    if args.max_depth is not None or args.max_children is not None or args.collapse_runs:
+        detail = LevelOfDetail(args.max_depth, args.max_children, args.collapse_runs)
+
+    started = time.perf_counter()
+    results = run_batch(inputs, args.output_dir, args.format, args.workers, args.timeout, progress, args.compress_drawio, args.profile, args.sidecars, args.drawio_pages, detail, args.section_workers)
+    elapsed = time.perf_counter() - started
+
+    failed = sum(1 for r in results if not r["ok"])
+    total_mb = sum(r["bytes"] for r in results) / (1024 * 1024)
+    print(
+        f"{len(results) - failed}/{len(results)} files converted in {elapsed:.2f}s "
+        f"({len(results) / elapsed:.1f} files/s, {total_mb / elapsed:.2f} MB/s compressed input)"
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""Microbenchmark: ExpressionRenderer vs. the per-branch expression loops it replaced.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_expressions --expressions 20000 --distinct 500
+"""
+import argparse
+import random
+import time
+
+from lxml import etree
+
+from expression_parser import ExpressionRenderer, ReferenceResolver, resolve_variable_name_from_reference
+
+
+def legacy_render(expr_elem, resolver):
+    """The loop previously copied into the Assignment handler of parse_node_structured."""
+    parts = []
+    for child in expr_elem:
+        if child.tag == "ExpressionChar":
+            parts.append(child.attrib.get("character", ""))
+        elif child.tag == "ExpressionToken":
+            parts.append(child.attrib.get("token", "").strip())
+        elif child.tag == "ExpressionVariable":
+            var_node = next(iter(child), None)
+            if var_node is not None:
+                name = var_node.attrib.get("name")
+                if name is None and "reference" in var_node.attrib:
+                    name = resolve_variable_name_from_reference(var_node, resolver)
+                parts.append(name or "?")
+            else:
+                parts.append("?")
+        elif child.tag == "ExpressionGeomFeature":
+            feature_elem = child.find(".//feature")
+            if feature_elem is not None:
+                parts.append(feature_elem.attrib.get("referencedName", "?"))
+            else:
+                parts.append("?")
+        else:
+            parts.append("?")
+    return "".join(parts).strip()
+
+
+def build_expressions(count, distinct, length, seed=0):
+    """`count` <expression> elements drawn from `distinct` different shapes."""
+    rnd = random.Random(seed)
+    templates = []
+    for _ in range(distinct):
+        template = []
+        for _ in range(length):
+            kind = rnd.random()
+            if kind < 0.3:
+                template.append(("ExpressionVariable", f"var_{rnd.randrange(50)}"))
+            elif kind < 0.5:
+                template.append(("ExpressionToken", rnd.choice([" and ", " or ", " + ", " == "])))
+            else:
+                template.append(("ExpressionChar", rnd.choice("0123456789<>()")))
+        templates.append(template)
+
+    root = etree.Element("children")
+    expressions = []
+    for _ in range(count):
+        expr = etree.SubElement(etree.SubElement(root, "Assignment"), "expression")
+        for tag, value in rnd.choice(templates):
+            if tag == "ExpressionVariable":
+                etree.SubElement(etree.SubElement(expr, tag), "ProgramVariable", name=value)
+            elif tag == "ExpressionToken":
+                etree.SubElement(expr, tag, token=value)
+            else:
+                etree.SubElement(expr, tag, character=value)
+        expressions.append(expr)
+    return root, expressions
+
+
+def best_of(repeat, func):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--expressions", type=int, default=20000)
+    parser.add_argument("--distinct", type=int, default=500, help="Number of different expression shapes")
+    parser.add_argument("--length", type=int, default=12, help="Parts per expression")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    _, expressions = build_expressions(args.expressions, args.distinct, args.length)
+
+    legacy_time, legacy_out = best_of(args.repeat, lambda: [legacy_render(e, ReferenceResolver()) for e in expressions])
+
+    def engine_run():
+        renderer = ExpressionRenderer()
+        return [renderer.render(e) for e in expressions], renderer
+
+    engine_time, (engine_out, renderer) = best_of(args.repeat, engine_run)
+    assert engine_out == legacy_out, "renderers disagree"
+
+    print(f"{args.expressions} expressions, {args.distinct} distinct, {args.length} parts each")
+    print(f"per-branch loop      {legacy_time * 1000:8.1f} ms")
+    print(f"ExpressionRenderer   {engine_time * 1000:8.1f} ms  (x{legacy_time / engine_time:.2f}, {renderer.hits} hits / {renderer.misses} misses)")
+
+
+if __name__ == "__main__":
+    main()
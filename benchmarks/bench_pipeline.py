@@ -0,0 +1,182 @@
+"""Benchmark every conversion stage on synthetic programs of growing size.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_pipeline --nodes 10000 100000 --output results.json
+    python -m benchmarks.bench_pipeline --nodes 10000 100000 --baseline results.json
+
+Each size is generated with benchmarks.generate_urp and written as a gzip'd
+.urp. The stages are timed separately (best of `--repeat`): decompression,
+lxml parsing, parse_node_structured (or, with `--section-workers`,
+section_parser.parse_program_parallel), the text render and the draw.io
+export. Peak memory is measured in an extra run of each stage under
+tracemalloc; it covers Python allocations, not libxml2's own.
+
+`--baseline` compares against a saved run and exits with status 1 if any
+stage got slower than `--tolerance` allows.
+"""
+import argparse
+import gzip
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from lxml import etree
+
+from benchmarks.generate_urp import generate_program, write_urp
+
+
+def stage_functions(path, section_workers=None):
+    """Stage name -> function of the previous stage's output."""
+    from drawio_exporter import generate_drawio_xml
+    from expression_parser import parse_node_structured
+    from section_parser import parse_program_parallel
+    from text_renderer import render_program_text
+    from urp_loader import END_TAG, START_TAG
+
+    def decompress(_):
+        with gzip.open(path, "rb") as f:
+            return f.read()
+
+    def xml_parse(data):
+        # The same slice and parser settings load_urprogram streams with
+        start = data.find(START_TAG)
+        end = data.find(END_TAG, start) + len(END_TAG)
+        return etree.fromstring(data[start:end], etree.XMLParser(recover=True, huge_tree=True))
+
+    def parse_structured(root):
+        if section_workers:
+            return parse_program_parallel(root, section_workers)
+        return parse_node_structured(root, root)
+
+    def render(structured_root):
+        render_program_text(structured_root)
+        return structured_root
+
+    return {
+        "decompress": decompress,
+        "xml_parse": xml_parse,
+        "parse_structured": parse_structured,
+        "render": render,
+        "drawio": generate_drawio_xml,
+    }
+
+
+def measure(path, repeat, section_workers=None):
+    """{stage: {"seconds": best time, "peak_bytes": tracemalloc peak}}."""
+    results = {}
+    value = None
+    for stage, func in stage_functions(path, section_workers).items():
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            output = func(value)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+
+        tracemalloc.start()
+        func(value)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results[stage] = {"seconds": best, "peak_bytes": peak}
+        value = output
+    return results
+
+
+def git_revision():
+    completed = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+    return completed.stdout.strip() or None
+
+
+def run(node_counts, repeat, generator_options, section_workers=None):
+    runs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for nodes in node_counts:
+            path = os.path.join(tmp, f"synthetic_{nodes}.urp")
+            write_urp(path, generate_program(nodes, **generator_options))
+            runs.append({"nodes": nodes, "file_bytes": os.path.getsize(path), "stages": measure(path, repeat, section_workers)})
+    return {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "generator": generator_options,
+        "section_workers": section_workers,
+        "runs": runs,
+    }
+
+
+def compare(current, baseline, tolerance):
+    """Lines describing each stage against the baseline, and whether any regressed."""
+    previous = {run["nodes"]: run["stages"] for run in baseline["runs"]}
+    lines = []
+    regressed = False
+    for run in current["runs"]:
+        old_stages = previous.get(run["nodes"])
+        if old_stages is None:
+            continue
+        for stage, timings in run["stages"].items():
+            if stage not in old_stages:
+                continue
+            ratio = timings["seconds"] / old_stages[stage]["seconds"]
+            slower = ratio > 1 + tolerance
+            regressed = regressed or slower
+            lines.append(f"{run['nodes']:>9} {stage:<17} x{ratio:5.2f}{'  REGRESSION' if slower else ''}")
+    return lines, regressed
+
+
+def format_run(run):
+    stages = "  ".join(
+        f"{stage} {timings['seconds'] * 1000:8.1f} ms/{timings['peak_bytes'] / (1024 * 1024):6.1f} MB"
+        for stage, timings in run["stages"].items()
+    )
+    return f"{run['nodes']:>9} nodes {run['file_bytes'] / 1024:8.0f} KB  {stages}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--depth", type=int, default=10)
+    parser.add_argument("--call-density", type=float, default=0.05)
+    parser.add_argument("--reference-density", type=float, default=0.5)
+    parser.add_argument("--expression-length", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--section-workers", type=int, default=None, help="Parse the top-level sections on this many processes")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown against the baseline (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    generator_options = {
+        "depth": args.depth,
+        "call_density": args.call_density,
+        "reference_density": args.reference_density,
+        "expression_length": args.expression_length,
+    }
+    current = run(args.nodes, args.repeat, generator_options, args.section_workers)
+    for result in current["runs"]:
+        print(format_run(result))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("generator") != generator_options:
+            print("warning: the baseline was generated with different options", file=sys.stderr)
+        lines, regressed = compare(current, baseline, args.tolerance)
+        print(f"\nagainst {baseline.get('revision') or args.baseline}:")
+        print("\n".join(lines))
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+"""Benchmark the cost of starting a fresh process and converting one program.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_startup --nodes 1000 --repeat 5
+
+Each scenario runs in a new interpreter (best of `--repeat` wall times):
+importing `urp_pipeline` alone, importing it and converting a synthetic
+program to text and draw.io, and the same conversion with the imports the
+Streamlit app pulls in (streamlit and every pipeline module) done up
+front, which is what reusing the app's code used to cost.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.generate_urp import generate_program, write_urp
+
+SCENARIOS = {
+    "import urp_pipeline": "import urp_pipeline",
+    "import + convert": (
+        "import urp_pipeline\n"
+        "urp_pipeline.convert({path!r}, ['text', 'drawio'])"
+    ),
+    "app imports + convert": (
+        "import streamlit\n"
+        "import background_export, diagnostics, drawio_exporter, expression_parser, layout, program_analysis, "
+        "program_diff, program_index, result_cache, text_renderer, urp_loader\n"
+        "import urp_pipeline\n"
+        "urp_pipeline.convert({path!r}, ['text', 'drawio'])"
+    ),
+}
+
+
+def time_process(code, repeat):
+    """Best wall time of running `code` in a fresh interpreter."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    results = {"python -c pass": time_process("pass", args.repeat)}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "startup.urp")
+        write_urp(path, generate_program(args.nodes))
+        for name, code in SCENARIOS.items():
+            try:
+                results[name] = time_process(code.format(path=path), args.repeat)
+            except subprocess.CalledProcessError:
+                results[name] = None  # e.g. streamlit not installed
+
+    for name, seconds in results.items():
+        print(f"{name:<24} {'n/a' if seconds is None else f'{seconds * 1000:8.1f} ms'}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"nodes": args.nodes, "seconds": results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""Benchmark parse, text render and draw.io layout on deeply nested programs.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_traversal --levels 250 1000 5000
+    python -m benchmarks.bench_traversal --levels 250 1000 --compare <git-rev>
+
+`--compare` runs the same measurements against the modules of another
+revision (which must contain text_renderer.py) in a subprocess. Recursive
+implementations get a raised recursion limit and a large thread stack there,
+so they have a chance to finish at all.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from lxml import etree
+
+MODULES = ["expression_parser.py", "drawio_exporter.py", "text_renderer.py", "program_node.py"]
+
+
+def nested_program(levels, siblings=2):
+    """URProgram whose MainProgram holds `levels` nested Folders, each with a few Comments."""
+    root = etree.Element("URProgram", name="nested")
+    parent = etree.SubElement(etree.SubElement(root, "children"), "MainProgram")
+    for level in range(levels):
+        children = etree.SubElement(parent, "children")
+        for i in range(siblings):
+            etree.SubElement(children, "Comment", comment=f"level {level} #{i}")
+        parent = etree.SubElement(children, "Folder", name=f"Level {level}")
+    return root
+
+
+def measure(levels, repeat):
+    from drawio_exporter import generate_drawio_xml
+    from expression_parser import parse_node_structured
+    from text_renderer import render_program_text
+
+    root = nested_program(levels)
+    timings = {}
+    for stage in ("parse", "render", "drawio"):
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            if stage == "parse":
+                structured_root = parse_node_structured(root, root)
+            elif stage == "render":
+                render_program_text(structured_root)
+            else:
+                generate_drawio_xml(structured_root)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        timings[stage] = best
+    return timings
+
+
+def measure_all(level_list, repeat):
+    results = {}
+    for levels in level_list:
+        try:
+            results[levels] = measure(levels, repeat)
+        except RecursionError as e:
+            results[levels] = {"error": f"RecursionError: {e}"}
+    return results
+
+
+def run_worker(level_list, repeat):
+    # Give recursive implementations room: deep recursion needs both a high
+    # limit and a big C stack, which only a fresh thread can get.
+    sys.setrecursionlimit(1_000_000)
+    threading.stack_size(512 * 1024 * 1024)
+    box = {}
+    thread = threading.Thread(target=lambda: box.update(measure_all(level_list, repeat)))
+    thread.start()
+    thread.join()
+    print(json.dumps(box))
+
+
+def run_revision(rev, level_list, repeat):
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as tmp:
+        for module in MODULES:
+            source = subprocess.run(
+                ["git", "show", f"{rev}:{module}"], cwd=repo_root, capture_output=True, check=True
+            ).stdout
+            with open(os.path.join(tmp, module), "wb") as f:
+                f.write(source)
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker", "--repeat", str(repeat), "--levels", *map(str, level_list)],
+            env={**os.environ, "PYTHONPATH": tmp},
+            capture_output=True,
+            text=True,
+        )
+        if completed.returncode != 0:
+            return {levels: {"error": f"crashed (exit code {completed.returncode})"} for levels in level_list}
+        return {int(levels): timings for levels, timings in json.loads(completed.stdout).items()}
+
+
+def format_row(label, levels, timings):
+    if "error" in timings:
+        return f"{label:<10} {levels:>7}  {timings['error']}"
+    return f"{label:<10} {levels:>7}  " + "  ".join(f"{stage} {seconds * 1000:9.1f} ms" for stage, seconds in timings.items())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--levels", type=int, nargs="+", default=[250, 1000, 5000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--compare", metavar="REV", help="Also measure the implementation at this git revision")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        run_worker(args.levels, args.repeat)
+        return
+
+    current = measure_all(args.levels, args.repeat)
+    previous = run_revision(args.compare, args.levels, args.repeat) if args.compare else {}
+
+    for levels in args.levels:
+        print(format_row("current", levels, current[levels]))
+        if args.compare:
+            print(format_row(args.compare[:10], levels, previous[levels]))
+            if "error" not in current[levels] and "error" not in previous[levels]:
+                speedups = "  ".join(
+                    f"{stage} x{previous[levels][stage] / seconds:.2f}" for stage, seconds in current[levels].items()
+                )
+                print(f"{'speedup':<10} {levels:>7}  {speedups}")
+
+
+if __name__ == "__main__":
+    main()
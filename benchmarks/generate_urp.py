@@ -0,0 +1,192 @@
+"""Write synthetic gzip'd .urp programs for benchmarking.
+
+Run from the repository root:
+
+    python -m benchmarks.generate_urp out.urp --nodes 100000 --depth 12 --call-density 0.05 \
+        --reference-density 0.5 --expression-length 12
+
+The program has a MainProgram of `--nodes` program nodes nested in Folders,
+Loops and Ifs up to `--depth` levels, plus a handful of SubProgram
+definitions. `--call-density` is the share of statements that call a
+subprogram; `--reference-density` is the share of variable uses written as
+`reference` XPaths instead of names.
+"""
+import argparse
+import gzip
+import random
+
+from lxml import etree
+
+# Ifs are rarer: the draw.io layout only draws their first branch node
+CONTAINERS = ("Folder", "Loop", "If")
+CONTAINER_WEIGHTS = (0.45, 0.45, 0.1)
+VARIABLES = 50
+SUBPROGRAMS = 8
+SUBPROGRAM_NODES = 20
+
+
+class _Builder:
+    def __init__(self, rnd, call_density, reference_density, expression_length):
+        self.rnd = rnd
+        self.call_density = call_density
+        self.reference_density = reference_density
+        self.expression_length = expression_length
+        self.variables = []  # <variable name=...> elements references point at
+        self.subprograms = []
+        # (element, target) pairs; relative XPaths are filled in once the tree is complete
+        self.references = []
+
+    def variable_use(self, parent, tag):
+        """A variable element under `parent`, by name or by reference."""
+        if self.variables and self.rnd.random() < self.reference_density:
+            element = etree.SubElement(parent, tag)
+            self.references.append((element, self.rnd.choice(self.variables)))
+        else:
+            element = etree.SubElement(parent, tag, name=f"var_{self.rnd.randrange(VARIABLES)}")
+        return element
+
+    def expression(self, parent):
+        expr = etree.SubElement(parent, "expression")
+        rnd = self.rnd
+        for _ in range(self.expression_length):
+            kind = rnd.random()
+            if kind < 0.3:
+                self.variable_use(etree.SubElement(expr, "ExpressionVariable"), "ProgramVariable")
+            elif kind < 0.5:
+                etree.SubElement(expr, "ExpressionToken", token=rnd.choice([" and ", " or ", " + ", " == "]))
+            else:
+                etree.SubElement(expr, "ExpressionChar", character=rnd.choice("0123456789<>()"))
+        return expr
+
+    def statement(self, children):
+        """Append one leaf program node; returns the number of program nodes added."""
+        rnd = self.rnd
+        if self.subprograms and rnd.random() < self.call_density:
+            target = rnd.choice(self.subprograms)
+            if rnd.random() < 0.5:
+                call = etree.SubElement(children, "CallSubProgram")
+                self.references.append((etree.SubElement(call, "subprogram"), target))
+            else:
+                # Embedded occurrence, parsed as a shared reference to the body
+                self.references.append((etree.SubElement(children, "SubProgram"), target))
+            return 1
+        kind = rnd.random()
+        if kind < 0.4:
+            assignment = etree.SubElement(children, "Assignment", valueSource="Expression")
+            self.variable_use(assignment, "variable")
+            self.expression(assignment)
+        elif kind < 0.55:
+            etree.SubElement(children, "Comment", comment=f"step {rnd.randrange(1000)}")
+        elif kind < 0.7:
+            wait = etree.SubElement(children, "Wait", type="Sleep")
+            etree.SubElement(wait, "waitTime").text = f"{rnd.randrange(1, 50) / 10}"
+        elif kind < 0.85:
+            move = etree.SubElement(children, "Move", motionType=rnd.choice(["MoveJ", "MoveL"]))
+            waypoints = etree.SubElement(move, "children")
+            for _ in range(2):
+                etree.SubElement(waypoints, "Waypoint", name=f"Waypoint_{rnd.randrange(500)}")
+            return 3
+        else:
+            set_node = etree.SubElement(children, "Set", type="DigitalOutput")
+            etree.SubElement(set_node, "pin", referencedName=f"digital_out[{rnd.randrange(8)}]")
+            etree.SubElement(set_node, "digitalValue").text = rnd.choice(["true", "false"])
+        return 1
+
+    def container(self, children):
+        tag = self.rnd.choices(CONTAINERS, CONTAINER_WEIGHTS)[0]
+        if tag == "Folder":
+            element = etree.SubElement(children, "Folder", name=f"Folder {self.rnd.randrange(1000)}")
+        elif tag == "Loop":
+            element = etree.SubElement(children, "Loop", type="While")
+            self.expression(element)
+        else:
+            element = etree.SubElement(children, "If", type="If")
+            self.expression(element)
+        return etree.SubElement(element, "children")
+
+    def body(self, children, nodes, depth):
+        """Fill `children` with `nodes` program nodes nested at most `depth` levels."""
+        rnd = self.rnd
+        open_children = [children]
+        added = 0
+        while added < nodes:
+            roll = rnd.random()
+            if len(open_children) <= depth and roll < 0.15:
+                open_children.append(self.container(open_children[-1]))
+                added += 1
+            elif len(open_children) > 1 and roll < 0.22:
+                open_children.pop()
+            else:
+                added += self.statement(open_children[-1])
+
+
+def relative_path(tree, element, target):
+    """XPath from `element` to `target` made of `..` steps and a downward path."""
+    # Keyed by the elements themselves: lxml reuses a node's proxy only while
+    # it is alive, so ids of temporary proxies would not be stable.
+    ancestors = {a: ups for ups, a in enumerate(element.iterancestors(), start=1)}
+    ups = 0
+    common = target
+    for common in target.iterancestors():
+        if common in ancestors:
+            ups = ancestors[common]
+            break
+    return "/".join([".."] * ups) + tree.getpath(target)[len(tree.getpath(common)):]
+
+
+def generate_program(nodes=10000, depth=10, call_density=0.05, reference_density=0.5, expression_length=8, seed=0):
+    """Build a <URProgram> element with roughly `nodes` program nodes."""
+    builder = _Builder(random.Random(seed), call_density, reference_density, expression_length)
+    root = etree.Element("URProgram", name="synthetic", directory="/programs")
+    top = etree.SubElement(root, "children")
+    main = etree.SubElement(top, "MainProgram", runOnlyOnce="false")
+    main_children = etree.SubElement(main, "children")
+
+    # Definitions first, so references have something to point at
+    for i in range(VARIABLES):
+        assignment = etree.SubElement(main_children, "Assignment", valueSource="Expression")
+        builder.variables.append(etree.SubElement(assignment, "variable", name=f"var_{i}", prefersPersistentValue="false"))
+        builder.expression(assignment)
+    subprogram_bodies = []
+    for i in range(SUBPROGRAMS):
+        subprogram = etree.SubElement(top, "SubProgram", name=f"Sub_{i}", keepHidden="false")
+        builder.subprograms.append(subprogram)
+        subprogram_bodies.append(etree.SubElement(subprogram, "children"))
+
+    builder.body(main_children, max(0, nodes - VARIABLES - SUBPROGRAMS * SUBPROGRAM_NODES), depth)
+    # Subprogram bodies do not call other subprograms, so expanding them
+    # always terminates.
+    saved, builder.subprograms = builder.subprograms, []
+    for body in subprogram_bodies:
+        builder.body(body, SUBPROGRAM_NODES, min(depth, 3))
+    builder.subprograms = saved
+
+    tree = root.getroottree()
+    for element, target in builder.references:
+        element.set("reference", relative_path(tree, element, target))
+    return root
+
+
+def write_urp(path, root, compresslevel=6):
+    """gzip the program the way Polyscope stores it."""
+    with gzip.open(path, "wb", compresslevel=compresslevel) as f:
+        f.write(etree.tostring(root, xml_declaration=True, encoding="UTF-8"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output", help="Path of the .urp file to write")
+    parser.add_argument("--nodes", type=int, default=10000, help="Approximate number of program nodes")
+    parser.add_argument("--depth", type=int, default=10, help="Maximum nesting depth of the main program")
+    parser.add_argument("--call-density", type=float, default=0.05, help="Share of statements calling a subprogram")
+    parser.add_argument("--reference-density", type=float, default=0.5, help="Share of variable uses written as references")
+    parser.add_argument("--expression-length", type=int, default=8, help="Parts per expression")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    root = generate_program(args.nodes, args.depth, args.call_density, args.reference_density, args.expression_length, args.seed)
+    write_urp(args.output, root)
+
+
+if __name__ == "__main__":
+    main()
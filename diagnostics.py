@@ -0,0 +1,76 @@
+import json
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+class Profile:
+    """Timings and counts collected while converting one program.
+
+    Pass an instance as `profile=` to `load_urprogram` and
+    `parse_node_structured`, and wrap further steps in `stage()`. Code that
+    is not given a profile skips the bookkeeping entirely. With
+    `trace_memory`, each stage also records its tracemalloc peak, which
+    covers Python allocations but not libxml2's.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.timers = defaultdict(float)
+        self.counters = Counter()
+        self.tag_counts = Counter()
+        self.tag_seconds = defaultdict(float)
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as stage `name`; stages should not nest."""
+        started_tracing = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            record = {"seconds": time.perf_counter() - started}
+            if self.trace_memory:
+                record["peak_bytes"] = tracemalloc.get_traced_memory()[1] - baseline
+                if started_tracing:
+                    tracemalloc.stop()
+            self.stages[name] = record
+
+    def add_time(self, name, seconds):
+        self.timers[name] += seconds
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def record_node(self, tag, seconds):
+        """One element handled by `parse_node_structured`'s per-tag logic."""
+        self.tag_counts[tag] += 1
+        self.tag_seconds[tag] += seconds
+
+    def to_dict(self):
+        return {
+            "stages": self.stages,
+            "timers": dict(self.timers),
+            "counters": dict(self.counters),
+            "tags": {
+                tag: {"count": count, "seconds": self.tag_seconds[tag]}
+                for tag, count in self.tag_counts.most_common()
+            },
+        }
+
+    def write_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def stage(profile, name):
+    """`profile.stage(name)`, or a no-op context when `profile` is None."""
+    return profile.stage(name) if profile is not None else nullcontext()
@@ -0,0 +1,296 @@
+"""The program flowchart in Graphviz DOT, Mermaid and SVG, next to draw.io.
+
+Every format is written from the same `layout.ProgramLayout`, through a
+`DiagramModel` holding its boxes and edges with the `SHAPE_MAP` styles of
+the draw.io export, so exporting several formats lays the program out once:
+
+    outputs = export_diagrams(tree, ["drawio", "svg", "dot"])
+
+DOT and SVG keep the layout's coordinates (render DOT with `neato -n2`);
+Mermaid lays the chart out itself.
+"""
+import io
+
+from drawio_exporter import REFERENCE_STYLE, SHAPE_MAP, SUMMARY_STYLE, node_label, safe_xml, write_drawio_xml
+from layout import COLLAPSED_GROUP_HEIGHT, SUMMARY_TYPE, VERTICAL_GAP, layout_program
+
+DIAGRAM_FORMATS = ("drawio", "dot", "mermaid", "svg")
+
+EDGE_LABELS = {"yes": "Yes", "no": "No"}
+SVG_PADDING = 20
+SVG_FONT_SIZE = 12
+SVG_LINE_HEIGHT = 16
+# Average glyph width at SVG_FONT_SIZE, to shorten labels that do not fit
+SVG_CHAR_WIDTH = 6.5
+
+# Output pieces collected before each write
+WRITE_BATCH = 1000
+
+_style_cache = {}
+
+
+def export_diagrams(root_node, formats, detail=None, compressed=False, analysis=None):
+    """{format: document} for each of `formats` (see DIAGRAM_FORMATS), from
+    one layout pass. `compressed` and `analysis` apply to draw.io."""
+    layout = layout_program(root_node, detail)
+    model = None
+    outputs = {}
+    for fmt in formats:
+        out = io.StringIO()
+        if fmt == "drawio":
+            write_drawio_xml(root_node, out, compressed, analysis, layout=layout)
+        else:
+            if model is None:
+                model = DiagramModel(layout)
+            EMITTERS[fmt](model, out)
+        outputs[fmt] = out.getvalue()
+    return outputs
+
+
+class DiagramModel:
+    """The boxes and edges of a `layout.ProgramLayout`, with each box's shape,
+    style and label resolved once for all emitters.
+
+    `boxes` holds `(x, y, width, height, shape, style, lines, kind)` in
+    drawing order, `style` being the draw.io style as a dict and kind one of
+    "node", "group" or "summary". `edges` are the layout's, and `children`
+    gives the indices of each box's children in the layout tree.
+    """
+
+    def __init__(self, layout):
+        cells = layout.cells
+        self.boxes = [
+            (cell.x, cell.y, cell.width, cell.height, *cell_style(cell), label_lines(cell),
+             "group" if cell.is_group else "summary" if cell.node["type"] == SUMMARY_TYPE else "node")
+            for cell in cells
+        ]
+        self.edges = layout.edges
+        self.children = [cell.children for cell in cells]
+
+    def nesting(self):
+        """Yield `(index, is_end)` over the layout tree, depth first: each
+        box once with `is_end` False, then each group again with `is_end`
+        True after the last of its descendants.
+
+        Boxes of a body laid out late come last in `boxes`, away from the
+        group holding them, so groups are closed by walking the tree rather
+        than by index ranges.
+        """
+        children = self.children
+        has_parent = bytearray(len(children))
+        for child_indices in children:
+            for child in child_indices:
+                has_parent[child] = 1
+        stack = [(index, False) for index in reversed(range(len(children))) if not has_parent[index]]
+        while stack:
+            index, is_end = stack.pop()
+            yield index, is_end
+            if is_end:
+                continue
+            if self.boxes[index][7] == "group":
+                stack.append((index, True))
+            stack.extend((child, False) for child in reversed(children[index]))
+
+
+def cell_style(cell):
+    """(shape, {style key: value}) of a layout cell, from its draw.io style."""
+    if cell.node["type"] == SUMMARY_TYPE:
+        style = SUMMARY_STYLE
+    elif cell.is_reference:
+        style = REFERENCE_STYLE
+    else:
+        style = SHAPE_MAP.get(cell.node["type"], "rectangle")
+    parsed = _style_cache.get(style)
+    if parsed is None:
+        parts = style.split(";")
+        shape = parts[0] if "=" not in parts[0] else "rectangle"
+        parsed = _style_cache[style] = (shape, dict(part.split("=", 1) for part in parts if "=" in part))
+    return parsed
+
+
+def label_lines(cell):
+    """Lines of text in a cell: waypoints of a Move, the counts of a summary,
+    each on their own line."""
+    node = cell.node
+    if cell.is_group:
+        return [node["displaytext"]]
+    if node["type"] == SUMMARY_TYPE:
+        return [node["displaytext"]] + [f"{count} × {node_type}" for node_type, count in node["counts"].items()]
+    if node["type"] == "Move":
+        return [f'Move: {node["displaytext"]}'] + [
+            f'• {child["displaytext"]}' for child in node.get("children", ()) if child["type"] == "Waypoint"
+        ]
+    return [node_label(node)]
+
+
+def write_dot(model, out):
+    """Graphviz DOT with pinned positions; Folder/Thread groups become
+    clusters headed by their title box."""
+    def quote(text):
+        return text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    shapes = {"ellipse": "ellipse", "rhombus": "diamond", "note": "note"}
+    out.write(
+        "digraph URProgram {\n"
+        '  graph [splines=ortho, outputorder=edgesfirst];\n'
+        '  node [fontname="Helvetica", fontsize=10];\n'
+        "  edge [arrowsize=0.7];\n"
+    )
+    parts = []
+    boxes = model.boxes
+    for index, is_end in model.nesting():
+        if is_end:
+            parts.append("  }\n")
+            continue
+        x, y, width, height, shape, style, lines, kind = boxes[index]
+        if kind == "group":
+            parts.append(f'  subgraph cluster_{index} {{\n    label="{quote(lines[0])}"; style="rounded,dashed";\n')
+            height = COLLAPSED_GROUP_HEIGHT
+        styles = "filled"
+        if style.get("rounded") == "1" or kind == "group":
+            styles += ",rounded"
+        if style.get("dashed") == "1":
+            styles += ",dashed"
+        label = "\\n".join(map(quote, lines))
+        parts.append(
+            f'  n{index} [label="{label}", shape={shapes.get(shape, "box")}, style="{styles}", '
+            f'fillcolor="{style.get("fillColor", "#ffffff")}", color="{style.get("strokeColor", "#000000")}", '
+            f'pos="{x + width / 2:g},{-(y + height / 2):g}!", '
+            f'width={width / 72:.3f}, height={height / 72:.3f}, fixedsize=true];\n'
+        )
+        if len(parts) >= WRITE_BATCH:
+            out.write("".join(parts))
+            parts.clear()
+    for source, target, kind in model.edges:
+        if kind in EDGE_LABELS:
+            parts.append(f'  n{source} -> n{target} [xlabel="{EDGE_LABELS[kind]}"];\n')
+        elif kind == "reference":
+            parts.append(f'  n{source} -> n{target} [style=dashed, arrowhead=open, color="#6c8ebf"];\n')
+        else:
+            parts.append(f"  n{source} -> n{target};\n")
+        if len(parts) >= WRITE_BATCH:
+            out.write("".join(parts))
+            parts.clear()
+    parts.append("}\n")
+    out.write("".join(parts))
+
+
+def write_mermaid(model, out):
+    """Mermaid flowchart; groups become subgraphs. Mermaid places the boxes
+    itself, so only the structure and styles of the layout carry over."""
+    def quote(text):
+        return '"' + text.replace("#", "#35;").replace('"', "#quot;") + '"'
+
+    brackets = {"ellipse": ("([", "])"), "rhombus": ("{", "}"), "note": (">", "]")}
+    classes = {}  # (fill, stroke, dashed) -> class name
+    parts = ["flowchart TD\n"]
+    boxes = model.boxes
+    for index, is_end in model.nesting():
+        if is_end:
+            parts.append("  end\n")
+            continue
+        _, _, _, _, shape, style, lines, kind = boxes[index]
+        key = (style.get("fillColor", "#ffffff"), style.get("strokeColor", "#000000"), style.get("dashed") == "1")
+        class_name = classes.setdefault(key, f"s{len(classes)}")
+        label = quote("<br>".join(lines))
+        if kind == "group":
+            parts.append(f"  subgraph n{index}[{label}]\n")
+        else:
+            opening, closing = brackets.get(shape, ("(", ")") if style.get("rounded") == "1" else ("[", "]"))
+            parts.append(f"  n{index}{opening}{label}{closing}:::{class_name}\n")
+        if len(parts) >= WRITE_BATCH:
+            out.write("".join(parts))
+            parts.clear()
+    for source, target, kind in model.edges:
+        if kind == "reference":
+            parts.append(f"  n{source} -.-> n{target}\n")
+        elif kind in EDGE_LABELS:
+            parts.append(f"  n{source} -->|{EDGE_LABELS[kind]}| n{target}\n")
+        else:
+            parts.append(f"  n{source} --> n{target}\n")
+        if len(parts) >= WRITE_BATCH:
+            out.write("".join(parts))
+            parts.clear()
+    for (fill, stroke, dashed), class_name in classes.items():
+        parts.append(f"  classDef {class_name} fill:{fill},stroke:{stroke}" + (",stroke-dasharray:5 5" if dashed else "") + "\n")
+    out.write("".join(parts))
+
+
+def write_svg(model, out):
+    """Standalone SVG at the layout's coordinates. Labels that do not fit
+    their box are shortened; the full text shows as a tooltip."""
+    boxes = model.boxes
+    min_x = min(box[0] for box in boxes) - SVG_PADDING
+    max_x = max(box[0] + box[2] for box in boxes) + SVG_PADDING
+    width = max_x - min_x
+    height = max(box[1] + box[3] for box in boxes) + 2 * SVG_PADDING
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="{min_x:g} {-SVG_PADDING} {width:g} {height:g}" '
+        f'width="{width:g}" height="{height:g}" font-family="Helvetica, Arial, sans-serif" font-size="{SVG_FONT_SIZE}">\n'
+        '<defs><marker id="arrow" viewBox="0 0 10 10" refX="10" refY="5" markerWidth="7" markerHeight="7" orient="auto-start-reverse">'
+        '<path d="M 0 0 L 10 5 L 0 10 z" fill="#555555"/></marker></defs>\n'
+        f'<rect x="{min_x:g}" y="{-SVG_PADDING}" width="{width:g}" height="{height:g}" fill="#ffffff"/>\n'
+    ]
+    for x, y, w, h, shape, style, lines, kind in boxes:
+        paint = f'fill="{style.get("fillColor", "#ffffff")}" stroke="{style.get("strokeColor", "#000000")}"'
+        if style.get("dashed") == "1":
+            paint += ' stroke-dasharray="5 5"'
+        if shape == "ellipse":
+            outline = f'<ellipse cx="{x + w / 2:g}" cy="{y + h / 2:g}" rx="{w / 2:g}" ry="{h / 2:g}" {paint}/>'
+        elif shape == "rhombus":
+            outline = f'<polygon points="{x + w / 2:g},{y:g} {x + w:g},{y + h / 2:g} {x + w / 2:g},{y + h:g} {x:g},{y + h / 2:g}" {paint}/>'
+        else:
+            rounded = ' rx="8"' if style.get("rounded") == "1" or kind == "group" else ""
+            outline = f'<rect x="{x:g}" y="{y:g}" width="{w:g}" height="{h:g}"{rounded} {paint}/>'
+
+        if kind == "node":
+            shown = lines[:max(1, int(h // SVG_LINE_HEIGHT) - 1)]
+            top = y + h / 2 - SVG_LINE_HEIGHT * (len(shown) - 1) / 2
+        else:
+            # Title in the header band only
+            shown, top = lines[:1], y + COLLAPSED_GROUP_HEIGHT / 2
+        max_chars = max(4, int(w / SVG_CHAR_WIDTH))
+        center = x + w / 2
+        text = "".join(
+            f'<tspan x="{center:g}" y="{top + i * SVG_LINE_HEIGHT:g}">'
+            f'{safe_xml(line if len(line) <= max_chars else line[:max_chars - 1] + "…")}</tspan>'
+            for i, line in enumerate(shown)
+        )
+        parts.append(
+            f"<g><title>{safe_xml(' / '.join(lines))}</title>{outline}"
+            f'<text text-anchor="middle" dominant-baseline="middle">{text}</text></g>\n'
+        )
+        if len(parts) >= WRITE_BATCH:
+            out.write("".join(parts))
+            parts.clear()
+
+    for source, target, kind in model.edges:
+        sx, sy, sw, sh = boxes[source][:4]
+        tx, ty, tw, th = boxes[target][:4]
+        if kind == "yes":
+            path = f"M {sx + sw:g} {sy + sh / 2:g} H {tx:g}"
+        elif kind == "no":
+            path = f"M {sx:g} {sy + sh / 2:g} H {tx + tw:g}"
+        elif kind == "reference":
+            path = f"M {sx + sw / 2:g} {sy + sh / 2:g} L {tx + tw / 2:g} {ty + th / 2:g}"
+        else:
+            # Down from the source, across, and down into the target
+            path = f"M {sx + sw / 2:g} {sy + sh:g} V {ty - VERTICAL_GAP / 2:g} H {tx + tw / 2:g} V {ty:g}"
+        stroke = 'stroke="#6c8ebf" stroke-dasharray="5 5"' if kind == "reference" else 'stroke="#555555"'
+        parts.append(f'<path d="{path}" fill="none" {stroke} marker-end="url(#arrow)"/>')
+        if kind in EDGE_LABELS:
+            label_x = (sx + sw + tx) / 2 if kind == "yes" else (sx + tx + tw) / 2
+            parts.append(f'<text x="{label_x:g}" y="{sy + sh / 2 - 6:g}" text-anchor="middle" font-size="10">{EDGE_LABELS[kind]}</text>')
+        parts.append("\n")
+        if len(parts) >= WRITE_BATCH:
+            out.write("".join(parts))
+            parts.clear()
+    parts.append("</svg>\n")
+    out.write("".join(parts))
+
+
+EMITTERS = {
+    "dot": write_dot,
+    "mermaid": write_mermaid,
+    "svg": write_svg,
+}
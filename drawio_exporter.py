@@ -1,12 +1,30 @@
+import base64
+import io
+import multiprocessing
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote
 from xml.sax.saxutils import escape
 
-# Layout constants
-VERTICAL_SPACING = 120
-HORIZONTAL_SPACING = 250
-NODE_WIDTH = 180
-NODE_HEIGHT = 70
-SECTION_SPACING = 300
-COLLAPSED_GROUP_HEIGHT = 40
+from layout import (
+    COLLAPSED_GROUP_HEIGHT,
+    HORIZONTAL_SPACING,
+    NODE_HEIGHT,
+    NODE_WIDTH,
+    GROUP_PADDING,
+    SUMMARY_TYPE,
+    VERTICAL_SPACING,
+    layout_program,
+)
+from program_node import ProgramNode
+from program_store import dump_program_tree, loads_program_tree
+
+# Characters JavaScript's encodeURIComponent leaves alone (besides A-Z a-z 0-9 _ . - ~)
+URI_COMPONENT_SAFE = "!*'()"
+COMPRESS_BATCH_CHARS = 64 * 1024
+# Cells written between two progress reports
+PROGRESS_INTERVAL = 1000
 
 # Style constants
 MAIN_PROGRAM_STYLE = "ellipse;fillColor=#d5e8d4;strokeColor=#82b366;fontStyle=1"
@@ -14,7 +32,19 @@ SUBROUTINE_STYLE = "ellipse;fillColor=#dae8fc;strokeColor=#6c8ebf"
 DECISION_STYLE = "rhombus;fillColor=#f8cecc;strokeColor=#b85450"
 ACTION_STYLE = "rounded=1;fillColor=#fff2cc;strokeColor=#d6b656"
 GROUP_STYLE = "rounded=1;fillColor=#f5f5f5;strokeColor=#666666;dashed=1"
+REFERENCE_STYLE = SUBROUTINE_STYLE + ";dashed=1"
+REFERENCE_EDGE_STYLE = "dashed=1;endArrow=open;strokeColor=#6c8ebf"
 MOVEMENT_STYLE = "rounded=0;fillColor=#e1d5e7;strokeColor=#9673a6"
+CYCLE_STYLE = ";strokeColor=#b85450;strokeWidth=2"
+SUMMARY_STYLE = f"swimlane;startSize={COLLAPSED_GROUP_HEIGHT};rounded=1;fillColor=#f5f5f5;strokeColor=#666666;dashed=1;fontStyle=2"
+SUMMARY_LINE_HEIGHT = 20
+
+EDGE_STYLES = {
+    "next": "",
+    "yes": "exitX=0.5;exitY=1;entryX=0;entryY=0;dashed=0;label=Yes",
+    "no": "exitX=0;exitY=0.5;entryX=0.5;entryY=1;dashed=0;label=No",
+    "reference": REFERENCE_EDGE_STYLE,
+}
 
 SHAPE_MAP = {
     "URProgram": "rectangle;fillColor=#f5f5f5;strokeColor=#666666;fontStyle=1;fontSize=16",
@@ -42,160 +72,290 @@ SHAPE_MAP = {
     "InitVariable": ACTION_STYLE
 }
 
+def node_label(node):
+    """Text of a program node's box, in every diagram format."""
+    node_type = node["type"]
+    display_text = node.get("displaytext", "")
+
+    # Special handling for different node types
+    if node_type == "Move":
+        label = f'Move: {display_text}'
+        if "children" in node and any(child["type"] == "Waypoint" for child in node["children"]):
+            waypoints = [f'• {child["displaytext"]}' for child in node["children"] if child["type"] == "Waypoint"]
+            label += f'\n{"".join(waypoints)}'
+    elif node_type in ["SubProgram", "CallSubProgram"]:
+        label = f'Sub: {display_text}'
+    elif node_type == "Folder":
+        label = f'Group: {display_text}'
+    else:
+        label = f'{node_type}: {display_text}'
+    return label
+
+
 def safe_xml(s):
     """Escape & clean XML attribute strings."""
     if s is None:
         return ""
     return escape(str(s).replace("\n", " ").replace("\r", ""), {'"': '&quot;'})
 
-def generate_drawio_xml(root_node):
-    node_elements = []
-    edge_elements = []
-    group_elements = []
-    counter = {"id": 1}
+class _CompressedDiagramWriter:
+    """Text sink that turns the mxGraphModel XML into draw.io's compressed
+    <diagram> payload, base64(deflateRaw(encodeURIComponent(xml))), as it is
+    written."""
+
+    def __init__(self, out):
+        self._out = out
+        self._deflate = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self._text = []
+        self._text_size = 0
+        self._pending = b""
+
+    def write(self, text):
+        # Cells arrive as many small strings; quote and deflate them in batches
+        self._text.append(text)
+        self._text_size += len(text)
+        if self._text_size >= COMPRESS_BATCH_CHARS:
+            self._compress_text()
+
+    def close(self):
+        self._compress_text()
+        self._emit(self._deflate.flush(), final=True)
+
+    def _compress_text(self):
+        text = "".join(self._text)
+        self._text.clear()
+        self._text_size = 0
+        self._emit(self._deflate.compress(quote(text, safe=URI_COMPONENT_SAFE).encode("ascii")))
+
+    def _emit(self, data, final=False):
+        # base64 works on 3-byte groups; hold back the remainder until more arrives
+        data = self._pending + data
+        cut = len(data) if final else len(data) - len(data) % 3
+        self._pending = data[cut:]
+        if cut:
+            self._out.write(base64.b64encode(data[:cut]).decode("ascii"))
+
+
+def generate_drawio_xml(root_node, compressed=False, analysis=None, progress=None, detail=None, layout=None):
+    out = io.StringIO()
+    write_drawio_xml(root_node, out, compressed, analysis, progress, detail, layout)
+    return out.getvalue()
+
+def write_drawio_xml(root_node, out, compressed=False, analysis=None, progress=None, detail=None, layout=None):
+    """Stream the draw.io document for `root_node` to the text file `out`.
+
+    Positions come from `layout.layout_program`; cells are written one by
+    one, edges last so they stay on top. With `compressed`, the diagram is
+    emitted as draw.io's native compressed payload. Given a
+    `program_analysis.ProgramAnalysis`, a second page shows the subprogram
+    call graph. `progress(done, total)` is called every `PROGRESS_INTERVAL`
+    cells of the program page; an exception it raises aborts the export.
+    A `layout.LevelOfDetail` draws an overview: the nodes it leaves out are
+    replaced by folded cells that list their counts when unfolded. A
+    `layout` already computed for `root_node` (see `diagram_emitters`) is
+    used as it is.
+    """
+    out.write(
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<mxfile host="app.diagrams.net">\n'
+    )
+    _write_diagram(out, "URProgram", 1, compressed, lambda model: _write_program_cells(model, root_node, progress, detail=detail, layout=layout))
+    if analysis is not None:
+        _write_diagram(out, "Call graph", 2, compressed, lambda model: _write_call_graph_cells(model, analysis))
+    out.write("</mxfile>\n")
+
+
+def generate_drawio_pages(root_node, compressed=False, analysis=None, progress=None, workers=None, detail=None):
+    out = io.StringIO()
+    write_drawio_pages(root_node, out, compressed, analysis, progress, workers, detail)
+    return out.getvalue()
+
+
+def write_drawio_pages(root_node, out, compressed=False, analysis=None, progress=None, workers=None, detail=None):
+    """Like `write_drawio_xml`, with one page per top-level section.
 
-    def next_id():
-        counter["id"] += 1
-        return str(counter["id"])
+    CallSubProgram and subprogram reference cells link to the page of the
+    subprogram they name. Pages are laid out and serialized on `workers`
+    processes (default: one per CPU), which receive their section in the
+    binary tree format, and are written in section order.
+    `progress(done, total)` counts finished pages.
+    """
+    sections = root_node["children"]
+    page_ids = [f"section-{i}" for i in range(len(sections))]
+    page_links = {}
+    for section, page_id in zip(sections, page_ids):
+        if section["type"] == "SubProgram":
+            page_links.setdefault(section["displaytext"], page_id)
 
-    def create_node(node, x, y, width=NODE_WIDTH, height=NODE_HEIGHT, style=None):
-        node_id = next_id()
+    jobs = []
+    for section, page_id in zip(sections, page_ids):
+        # Each page draws its own section in full, even a subprogram whose
+        # body was first parsed (and is drawn) elsewhere
+        page_root = ProgramNode(root_node["type"], root_node["displaytext"], root_node["depth"], [
+            ProgramNode(section["type"], section["displaytext"], section["depth"], section["children"], section.name, section.motion_type)
+        ])
+        name = f'{section["type"]}: {section["displaytext"]}' if section["type"] == "SubProgram" else section["displaytext"] or section["type"]
+        jobs.append((page_root, name, page_id, compressed, page_links, detail))
+
+    out.write(
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<mxfile host="app.diagrams.net">\n'
+    )
+    if progress is not None:
+        progress(0, len(jobs))
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if workers > 1:
+        # Sections travel to the workers in the binary tree format, which
+        # unlike pickle copes with any depth. spawn: the exporter may itself
+        # run on a thread of a larger process.
+        jobs = [(dump_program_tree(page_root), *rest) for page_root, *rest in jobs]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            for done, page in enumerate(pool.map(_render_page, jobs), 1):
+                out.write(page)
+                if progress is not None:
+                    progress(done, len(jobs))
+    else:
+        for done, job in enumerate(jobs, 1):
+            out.write(_render_page(job))
+            if progress is not None:
+                progress(done, len(jobs))
+    if analysis is not None:
+        _write_diagram(out, "Call graph", "call-graph", compressed, lambda model: _write_call_graph_cells(model, analysis))
+    out.write("</mxfile>\n")
+
+
+def _render_page(job):
+    # Returns the page's <diagram> element; in a worker process, the
+    # section arrives as a binary tree
+    page_root, name, page_id, compressed, page_links, detail = job
+    if isinstance(page_root, bytes):
+        page_root = loads_program_tree(page_root)
+    out = io.StringIO()
+    _write_diagram(out, name, page_id, compressed, lambda model: _write_program_cells(model, page_root, page_links=page_links, page_id=page_id, detail=detail))
+    return out.getvalue()
+
+
+def _write_diagram(out, name, diagram_id, compressed, write_cells):
+    # One <diagram> page; write_cells(model) writes its cells
+    model = _CompressedDiagramWriter(out) if compressed else out
+    out.write(f'  <diagram name="{safe_xml(name)}" id="{diagram_id}">')
+    if not compressed:
+        out.write("\n")
+    model.write(
+        '<mxGraphModel dx="1500" dy="1500" grid="1" gridSize="10" guides="1" tooltips="1" connect="1" arrows="1" fold="1" page="1" pageScale="1" pageWidth="850" pageHeight="1100">\n'
+        '<root>\n'
+        '<mxCell id="0"/>\n'
+        '<mxCell id="1" parent="0"/>\n'
+    )
+    write_cells(model)
+    model.write("</root>\n</mxGraphModel>")
+    if compressed:
+        model.close()
+    else:
+        out.write("\n")
+    out.write("</diagram>\n")
+
+
+def _write_program_cells(model, root_node, progress=None, page_links=None, page_id=None, detail=None, layout=None):
+    # page_links maps subprogram names to the ids of the pages drawing them;
+    # calls to a subprogram on another page link there
+    def create_node(node_id, node, x, y, width, height, style=None):
         node_type = node["type"]
         display_text = node.get("displaytext", "")
-        
-        # Special handling for different node types
-        if node_type == "Move":
-            label = f'Move: {display_text}'
-            if "children" in node and any(child["type"] == "Waypoint" for child in node["children"]):
-                waypoints = [f'• {child["displaytext"]}' for child in node["children"] if child["type"] == "Waypoint"]
-                label += f'\n{"".join(waypoints)}'
-                height = max(NODE_HEIGHT, 30 + (20 * len(waypoints)))
-        elif node_type in ["SubProgram", "CallSubProgram"]:
-            label = f'Sub: {display_text}'
-        elif node_type == "Folder":
-            label = f'Group: {display_text}'
-        else:
-            label = f'{node_type}: {display_text}'
-
         style = style or SHAPE_MAP.get(node_type, "rectangle")
-        label = safe_xml(label)
-
-        node_xml = f'''
-            <mxCell id="{node_id}" value="{label}" style="{style};whiteSpace=wrap;html=1;" vertex="1" parent="1">
-              <mxGeometry x="{x}" y="{y}" width="{width}" height="{height}" as="geometry"/>
-            </mxCell>
-        '''
-        node_elements.append(node_xml.strip())
-        return node_id
-
-    def connect(src_id, tgt_id, style=""):
-        edge_id = next_id()
-        edge_style = f"edgeStyle=orthogonalEdgeStyle;rounded=0;{style}"
-        edge_xml = f'''
-            <mxCell id="{edge_id}" style="{edge_style}" edge="1" parent="1" source="{src_id}" target="{tgt_id}">
-              <mxGeometry relative="1" as="geometry"/>
-            </mxCell>
-        '''
-        edge_elements.append(edge_xml.strip())
-
-    def create_group(x, y, width, height, label, parent_id="1"):
-        group_id = next_id()
-        group_xml = f'''
-            <mxCell id="{group_id}" value="{safe_xml(label)}" style="swimlane;whiteSpace=wrap;html=1;" vertex="1" parent="{parent_id}">
-              <mxGeometry x="{x}" y="{y}" width="{width}" height="{height}" as="geometry"/>
-            </mxCell>
-        '''
-        group_elements.append(group_xml.strip())
-        return group_id
-
-    def layout_section(node, start_x, start_y, parent_id=None):
-        if node["type"] in ["Folder", "Thread"]:
-            # Create a group for folders/threads
-            group_id = create_group(start_x, start_y, NODE_WIDTH * 2, SECTION_SPACING, node["displaytext"])
-            current_y = start_y + 40
-            first_child_id = None
-            last_child_id = None
-            
-            for child in node.get("children", []):
-                child_id = layout_node_tree(child, start_x + 20, current_y, group_id)
-                if not first_child_id:
-                    first_child_id = child_id
-                if last_child_id:
-                    connect(last_child_id, child_id)
-                last_child_id = child_id
-                current_y += VERTICAL_SPACING
-            
-            return group_id
+        label = safe_xml(node_label(node))
+
+        target_page = None
+        if page_links and (node_type == "CallSubProgram" or node.get("is_reference")):
+            target_page = page_links.get(display_text)
+        if target_page is not None and target_page != page_id:
+            model.write(
+                f'<UserObject label="{label}" link="data:page/id,{target_page}" id="{node_id}">'
+                f'<mxCell style="{style};whiteSpace=wrap;html=1;" vertex="1" parent="1">'
+                f'<mxGeometry x="{x}" y="{y}" width="{width}" height="{height}" as="geometry"/></mxCell></UserObject>\n'
+            )
+            return
+        model.write(
+            f'<mxCell id="{node_id}" value="{label}" style="{style};whiteSpace=wrap;html=1;" vertex="1" parent="1">'
+            f'<mxGeometry x="{x}" y="{y}" width="{width}" height="{height}" as="geometry"/></mxCell>\n'
+        )
+
+    def create_group(group_id, x, y, width, height, label, parent_id="1"):
+        model.write(
+            f'<mxCell id="{group_id}" value="{safe_xml(label)}" style="swimlane;whiteSpace=wrap;html=1;" vertex="1" parent="{parent_id}">'
+            f'<mxGeometry x="{x}" y="{y}" width="{width}" height="{height}" as="geometry"/></mxCell>\n'
+        )
+
+    def create_summary(cell_id, node, x, y, width, height):
+        # Folded container; unfolding it shows the counts of the nodes it
+        # stands in for
+        lines = [f"{count} × {node_type}" for node_type, count in node["counts"].items()]
+        expanded_height = COLLAPSED_GROUP_HEIGHT + SUMMARY_LINE_HEIGHT * len(lines) + GROUP_PADDING
+        model.write(
+            f'<mxCell id="{cell_id}" value="{safe_xml(node["displaytext"])}" style="{SUMMARY_STYLE};whiteSpace=wrap;html=1;" vertex="1" collapsed="1" parent="1">'
+            f'<mxGeometry x="{x}" y="{y}" width="{width}" height="{height}" as="geometry">'
+            f'<mxRectangle x="{x}" y="{y}" width="{width}" height="{expanded_height}" as="alternateBounds"/></mxGeometry></mxCell>\n'
+            f'<mxCell id="{cell_id}-counts" value="{safe_xml("<br>".join(lines))}" style="text;align=left;verticalAlign=top;whiteSpace=wrap;html=1;" vertex="1" parent="{cell_id}">'
+            f'<mxGeometry x="{GROUP_PADDING // 2}" y="{COLLAPSED_GROUP_HEIGHT}" width="{width - GROUP_PADDING}" height="{SUMMARY_LINE_HEIGHT * len(lines)}" as="geometry"/></mxCell>\n'
+        )
+
+    if layout is None:
+        # Subprograms drawn on pages of their own stay links
+        layout = layout_program(root_node, detail, page_links or ())
+    total = len(layout.cells) + len(layout.edges)
+    if progress is not None:
+        progress(0, total)
+    # Cell ids 0 and 1 are taken by the root cells _write_diagram writes
+    for index, cell in enumerate(layout.cells, 2):
+        if progress is not None and index % PROGRESS_INTERVAL == 0:
+            progress(index - 2, total)
+        if cell.is_group:
+            create_group(index, cell.x, cell.y, cell.width, cell.height, cell.node["displaytext"])
+        elif cell.node["type"] == SUMMARY_TYPE:
+            create_summary(index, cell.node, cell.x, cell.y, cell.width, cell.height)
+        elif cell.is_reference:
+            create_node(index, cell.node, cell.x, cell.y, cell.width, cell.height, REFERENCE_STYLE)
         else:
-            return layout_node_tree(node, start_x, start_y, parent_id)
-
-    def layout_node_tree(node, x, y, parent_id="1"):
-        this_id = create_node(node, x, y)
-        
-        # Handle special cases
-        if node["type"] == "If":
-            # Layout If-Then-Else structure
-            then_branch = next((c for c in node["children"] if c["type"] != "Else"), None)
-            else_branch = next((c for c in node["children"] if c["type"] == "Else"), None)
-            
-            if then_branch:
-                then_id = layout_node_tree(then_branch, x + HORIZONTAL_SPACING, y)
-                connect(this_id, then_id, "exitX=0.5;exitY=1;entryX=0;entryY=0;dashed=0;label=Yes")
-            
-            if else_branch:
-                else_id = layout_node_tree(else_branch, x - HORIZONTAL_SPACING, y)
-                connect(this_id, else_id, "exitX=0;exitY=0.5;entryX=0.5;entryY=1;dashed=0;label=No")
-                
-            return this_id
-        
-        # Default layout for other nodes
-        children = node.get("children", [])
-        if children:
-            first_child_id = None
-            last_child_id = None
-            current_y = y + VERTICAL_SPACING
-            
-            for child in children:
-                child_id = layout_node_tree(child, x, current_y, parent_id)
-                if not first_child_id:
-                    first_child_id = child_id
-                    connect(this_id, child_id)
-                if last_child_id:
-                    connect(last_child_id, child_id)
-                last_child_id = child_id
-                current_y += VERTICAL_SPACING
-                
-        return this_id
-
-    # Start layout with program title
-    program_title_id = create_node(
-        {"type": "URProgram", "displaytext": root_node["displaytext"]},
-        0, 0, NODE_WIDTH * 2, NODE_HEIGHT * 1.5
-    )
-    
-    # Layout main sections vertically
-    current_y = NODE_HEIGHT * 2
-    last_section_id = None
-    
-    for child in root_node.get("children", []):
-        section_id = layout_section(child, 0, current_y)
-        if last_section_id:
-            connect(last_section_id, section_id)
-        last_section_id = section_id
-        current_y += SECTION_SPACING
-
-    drawio_xml = f'''<?xml version="1.0" encoding="UTF-8"?>
-<mxfile host="app.diagrams.net">
-  <diagram name="URProgram" id="1">
-    <mxGraphModel dx="1500" dy="1500" grid="1" gridSize="10" guides="1" tooltips="1" connect="1" arrows="1" fold="1" page="1" pageScale="1" pageWidth="850" pageHeight="1100">
-      <root>
-        <mxCell id="0"/>
-        <mxCell id="1" parent="0"/>
-        {"".join(group_elements)}
-        {"".join(node_elements)}
-        {"".join(edge_elements)}
-      </root>
-    </mxGraphModel>
-  </diagram>
-</mxfile>'''
-    return drawio_xml
\ No newline at end of file
+            create_node(index, cell.node, cell.x, cell.y, cell.width, cell.height)
+
+    for edge_id, (src, tgt, kind) in enumerate(layout.edges, len(layout.cells) + 2):
+        if progress is not None and edge_id % PROGRESS_INTERVAL == 0:
+            progress(edge_id - 2, total)
+        model.write(
+            f'<mxCell id="{edge_id}" style="edgeStyle=orthogonalEdgeStyle;rounded=0;{EDGE_STYLES[kind]}" edge="1" parent="1" source="{src + 2}" target="{tgt + 2}">'
+            f'<mxGeometry relative="1" as="geometry"/></mxCell>\n'
+        )
+
+
+def _write_call_graph_cells(model, analysis):
+    # Callers above callees: one row per call distance from the top-level
+    # sections, subprograms nobody calls in a last row. Members of call
+    # cycles and the calls between them are drawn in red.
+    graph = analysis.call_graph()
+    depths = analysis.call_depths()
+    recursive = {name for cycle in analysis.cycles() for name in cycle}
+    last_row = max((depth for depth in depths.values() if depth is not None), default=-1) + 1
+    rows = {}
+    cell_ids = {}
+    for cell_id, name in enumerate(graph, 2):
+        row = depths[name] if depths[name] is not None else last_row
+        column = rows.setdefault(row, 0)
+        rows[row] += 1
+        cell_ids[name] = cell_id
+        style = MAIN_PROGRAM_STYLE if depths[name] == 0 else SUBROUTINE_STYLE
+        if name in recursive:
+            style += CYCLE_STYLE
+        model.write(
+            f'<mxCell id="{cell_id}" value="{safe_xml(name)}" style="{style};whiteSpace=wrap;html=1;" vertex="1" parent="1">'
+            f'<mxGeometry x="{column * HORIZONTAL_SPACING}" y="{row * VERTICAL_SPACING * 3 // 2}" width="{NODE_WIDTH}" height="{NODE_HEIGHT}" as="geometry"/></mxCell>\n'
+        )
+
+    edge_id = len(graph) + 2
+    for caller, callees in graph.items():
+        for callee in callees:
+            style = CYCLE_STYLE if caller in recursive and callee in recursive else ""
+            model.write(
+                f'<mxCell id="{edge_id}" style="rounded=0;endArrow=block{style}" edge="1" parent="1" source="{cell_ids[caller]}" target="{cell_ids[callee]}">'
+                f'<mxGeometry relative="1" as="geometry"/></mxCell>\n'
+            )
+            edge_id += 1
@@ -1,57 +1,313 @@
+from itertools import islice
+from time import perf_counter
+
 from lxml import etree
 
-def resolve_variable_name_from_reference(ref_element):
+from program_node import NO_CHILDREN, ProgramNode
+
+
+class ReferenceResolver:
+    """Resolves `reference` XPaths once per document and caches the targets.
+
+    References are normalized by climbing their leading `..` steps to an
+    anchor element, so the thousands of identical references to the same
+    variable from different places share one cache entry keyed by
+    (anchor element, remaining path). Compiled XPaths are cached as well.
+    """
+
+    def __init__(self):
+        self._targets = {}
+        self._compiled = {}
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, element, ref=None):
+        """Return the first node `ref` points at from `element`, or None.
+
+        `ref` defaults to the element's own `reference` attribute. Raises
+        `etree.XPathError` for malformed references, like `element.xpath`.
+        An empty reference points nowhere.
+        """
+        if ref is None:
+            ref = element.attrib.get("reference", "")
+        if not ref:
+            return None
+
+        anchor = element
+        rest = ref
+        if ref.startswith("/"):
+            anchor = None
+        else:
+            # Leading "../" and "./" steps become the anchor, the rest is the key.
+            ups = 0
+            while True:
+                if rest.startswith("../"):
+                    ups += 1
+                    rest = rest[3:]
+                elif rest.startswith("./"):
+                    rest = rest[2:]
+                else:
+                    break
+            if rest in (".", ".."):
+                ups += rest == ".."
+                rest = ""
+            if rest.startswith("/"):
+                # A descendant step (".//v"); not worth normalizing
+                return self._first(element.xpath(ref))
+            if ups:
+                anchor = next(islice(element.iterancestors(), ups - 1, None), None)
+                if anchor is None:
+                    # Climbed past the root element; let lxml handle it.
+                    return self._first(element.xpath(ref))
+
+        key = (anchor, rest)
+        if key in self._targets:
+            self.hits += 1
+            return self._targets[key]
+        self.misses += 1
+
+        if anchor is None:
+            target = self._first(element.xpath(ref))
+        elif not rest:
+            target = anchor
+        else:
+            compiled = self._compiled.get(rest)
+            if compiled is None:
+                compiled = self._compiled[rest] = etree.XPath(rest)
+            target = self._first(compiled(anchor))
+
+        self._targets[key] = target
+        return target
+
+    @staticmethod
+    def _first(result):
+        if isinstance(result, list):
+            return result[0] if result else None
+        return None
+
+
+def resolve_variable_name_from_reference(ref_element, resolver=None):
+    resolver = resolver or ReferenceResolver()
     try:
-        ref_path = ref_element.attrib.get("reference", "")
-        target = ref_element.xpath(ref_path)
-        if target and isinstance(target[0], etree._Element):
-            return target[0].attrib.get("name", "?")
+        target = resolver.resolve(ref_element)
+        if isinstance(target, etree._Element):
+            return target.attrib.get("name", "?")
     except Exception:
         pass
     return "?"
 
-def resolve_subprogram_name(reference: str, context_node):
-    target = context_node.xpath(reference)
-    if target:
-        sub_node = target[0]
-        return sub_node.attrib.get("name")
+def _is_known_name(name):
+    """False for the placeholders drawn for a name that could not be read."""
+    return bool(name) and name != "?" and not name.startswith("(XPath error")
+
+def resolve_subprogram_name(reference: str, context_node, resolver=None):
+    resolver = resolver or ReferenceResolver()
+    target = resolver.resolve(context_node, reference)
+    if target is not None:
+        return target.attrib.get("name")
     return None
 
-def parse_expression(expr_elem):
-    parts = []
-
-    if expr_elem is None:
-        return "?"
-
-    for child in expr_elem:
-        tag = child.tag
-
-        if tag == "ExpressionChar":
-            parts.append(child.attrib.get("character", ""))
-        elif tag == "ExpressionToken":
-            parts.append(child.attrib.get("token", "").strip())
-        elif tag == "ExpressionVariable":
-            var_elem = child.find("*")  # could be ProgramVariable or InstallationVariable
-            if var_elem is not None:
-                name = var_elem.attrib.get("name")
-                if name is None and "reference" in var_elem.attrib:
-                    name = resolve_variable_name_from_reference(var_elem)
-                parts.append(name or "?")
-            else:
-                parts.append("?")
-        elif tag == "ExpressionGeomFeature":
-            feature = child.find("feature")
-            if feature is not None:
-                parts.append(feature.attrib.get("referencedName", "?"))
-            else:
-                parts.append("?")
+# Misses after which the expression cache checks whether it is paying off
+MEMO_PROBE_MISSES = 1000
+
+
+class ExpressionRenderer:
+    """Renders URScript expression elements to text, memoized.
+
+    Expression parts (`ExpressionChar`, `ExpressionToken`, ...) are rendered
+    through a tag-dispatch table. Results are cached by the expression's
+    serialized form, so a repeated expression is rendered once. Expressions
+    that contain relative `reference`s depend on their position, so those
+    are cached per element instead. Memoization switches itself off when
+    the document turns out to have few repeated expressions.
+
+    With `track_variables`, the names of the variables each rendered
+    expression reads are appended to `used_variables` (cached results
+    included), for the caller to drain.
+    """
+
+    def __init__(self, resolver=None, track_variables=False):
+        self.resolver = resolver or ReferenceResolver()
+        self.used_variables = [] if track_variables else None
+        self._names = []
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+        self._memoize = True
+        self._dispatch = {
+            "ExpressionChar": self._render_char,
+            "ExpressionToken": self._render_token,
+            "ExpressionVariable": self._render_variable,
+            "ExpressionGeomFeature": self._render_geom_feature,
+        }
+
+    def render(self, expr_elem):
+        """Render the parts directly under `expr_elem`; "?" if it is None."""
+        if expr_elem is None:
+            return "?"
+        return self._memoized(expr_elem, expr_elem)
+
+    def render_descendants(self, elem):
+        """Render every expression part anywhere below `elem`, in document order."""
+        return self._memoized(elem, elem.iter(*self._dispatch))
+
+    def _memoized(self, elem, parts):
+        if not self._memoize:
+            rendered = self._render_parts(parts)
+            return rendered if self.used_variables is None else self._track(rendered)
+
+        key = etree.tostring(elem)
+        if b"reference=" in key:
+            key = elem
+        cached = self._cache.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached if self.used_variables is None else self._track(cached)
+        self.misses += 1
+        if self.misses >= MEMO_PROBE_MISSES and self.hits * 4 < self.misses:
+            # Expressions hardly repeat in this document; serializing them
+            # for the cache key costs more than it saves.
+            self._memoize = False
+            self._cache.clear()
+
+        rendered = self._cache[key] = self._render_parts(parts)
+        return rendered if self.used_variables is None else self._track(rendered)
+
+    def _render_parts(self, parts):
+        # Returns the text, or (text, variable names) when tracking variables
+        dispatch = self._dispatch
+        rendered = []
+        for part in parts:
+            handler = dispatch.get(part.tag)
+            rendered.append(handler(part) if handler else "?")
+        text = "".join(rendered).strip()
+        if self.used_variables is None:
+            return text
+        names = tuple(self._names)
+        self._names.clear()
+        return text, names
+
+    def _track(self, rendered):
+        text, names = rendered
+        self.used_variables.extend(names)
+        return text
+
+    # Handlers use element.get() and C-level iterators rather than
+    # .attrib.get() and .find(path), which go through much slower paths.
+    @staticmethod
+    def _render_char(part):
+        return part.get("character", "")
+
+    @staticmethod
+    def _render_token(part):
+        return part.get("token", "").strip()
+
+    def _render_variable(self, part):
+        # could be ProgramVariable or InstallationVariable
+        var_elem = next(part.iterchildren(etree.Element), None)
+        if var_elem is None:
+            return "?"
+        name = var_elem.get("name")
+        if name is None and var_elem.get("reference") is not None:
+            name = resolve_variable_name_from_reference(var_elem, self.resolver)
+        if _is_known_name(name) and self.used_variables is not None:
+            self._names.append(name)
+        return name or "?"
+
+    @staticmethod
+    def _render_geom_feature(part):
+        feature = next(part.iter("feature"), None)
+        if feature is None:
+            return "?"
+        return feature.get("referencedName", "?")
+
+
+def parse_expression(expr_elem, resolver=None):
+    return ExpressionRenderer(resolver).render(expr_elem)
+
+
+def parse_node_structured(node, root, depth=0, resolver=None, subprograms=None, profile=None, index=None, analysis=None):
+    """Parse `node` and its whole subtree into a ProgramNode tree.
+
+    Walks the tree with an explicit stack, so arbitrarily deep programs do
+    not hit Python's recursion limit. A `diagnostics.Profile` passed as
+    `profile` receives the count and handling time of every tag plus the
+    reference and expression cache statistics. A `program_index.ProgramIndex`
+    passed as `index` and a `program_analysis.ProgramAnalysis` passed as
+    `analysis` are filled with every parsed node in the same pass.
+    """
+    if resolver is None:
+        resolver = ReferenceResolver()
+    if subprograms is None:
+        subprograms = {}
+    collectors = [collector for collector in (index, analysis) if collector is not None]
+    expressions = ExpressionRenderer(resolver, track_variables=bool(collectors))
+    if profile is not None:
+        resolver_hits, resolver_misses = resolver.hits, resolver.misses
+    facts = None
+    if collectors:
+        facts = []
+        node_ids = {}  # id(parsed node) -> node id, for the parent links
+
+    result = None
+    # Entries are (element, root passed to its handler, depth, parsed parent,
+    # parent entry). The parent entry chain keeps every ancestor's lxml proxy
+    # alive, as the recursive version's frames did; without it, freeing a
+    # proxy makes lxml walk all the way up to the root.
+    stack = [(node, root, depth, None, None)]
+    while stack:
+        entry = stack.pop()
+        element, element_root, element_depth, parent, _ = entry
+        if profile is None:
+            parsed, child_elements, child_root = _parse_single_node(element, element_root, element_depth, resolver, subprograms, expressions, facts)
         else:
-            parts.append("?")
-
-    return "".join(parts).strip()
-
-
-def parse_node_structured(node, root, depth=0):
+            started = perf_counter()
+            parsed, child_elements, child_root = _parse_single_node(element, element_root, element_depth, resolver, subprograms, expressions, facts)
+            profile.record_node(element.tag, perf_counter() - started)
+        if parent is None:
+            result = parsed
+        else:
+            parent.children.append(parsed)
+
+        if collectors:
+            facts.extend(("uses", name) for name in expressions.used_variables)
+            expressions.used_variables.clear()
+            parent_id = node_ids[id(parent)] if parent is not None else None
+            # Every collector numbers the nodes the same way
+            for collector in collectors:
+                node_id = collector.add(parsed, parent_id, facts)
+            node_ids[id(parsed)] = node_id
+            facts.clear()
+            if parsed.children and not child_elements and not parsed.is_reference:
+                # Built by the handler itself (InitVariable entries)
+                for child in parsed.children:
+                    for collector in collectors:
+                        collector.add(child, node_id, (("variable", child.name),) if child.name else ())
+
+        if child_elements:
+            if parsed.children is NO_CHILDREN:
+                parsed.children = []
+            # Reversed, so children are popped (and appended) in document order
+            for child in reversed(child_elements):
+                stack.append((child, child_root, element_depth + 1, parsed, entry))
+
+    if profile is not None:
+        profile.count("reference_cache_hits", resolver.hits - resolver_hits)
+        profile.count("xpath_resolutions", resolver.misses - resolver_misses)
+        profile.count("expression_cache_hits", expressions.hits)
+        profile.count("expressions_rendered", expressions.misses)
+    return result
+
+
+def _parse_single_node(node, root, depth, resolver, subprograms, expressions, facts=None):
+    """Build the ProgramNode for one element, without its children.
+
+    Returns (parsed node, child elements still to parse, root for those
+    children). If `facts` is a list, the names the node refers to are
+    appended to it as (kind, name) pairs, kind being "variable" (assigned),
+    "subprogram", "pin" or "tcp". parse_node_structured adds the variables
+    read by the node's expressions as "uses".
+    """
     if node.tag == "SuppressedNode" or node.tag == "suppressedNode":
         is_suppressed = True
 
@@ -62,15 +318,7 @@ def parse_node_structured(node, root, depth=0):
             # let the normal logic parse it, mark suppressed later
         else:
             # Case 2: Folder-like suppressedNode with multiple children
-            return {
-                "type": "Suppressed",
-                "displaytext": "[commented out]",
-                "depth": depth,
-                "children": [
-                    parsed for child in node.findall("./children/*")
-                    if (parsed := parse_node_structured(child, node, depth + 1)) is not None
-                ]
-            }
+            return ProgramNode("Suppressed", "[commented out]", depth), node.findall("./children/*"), node
 
 
 
@@ -85,40 +333,15 @@ def parse_node_structured(node, root, depth=0):
         if var_elem is not None:
             var_name = var_elem.attrib.get("name")
             if var_name is None and "reference" in var_elem.attrib:
-                var_name = resolve_variable_name_from_reference(var_elem)
+                var_name = resolve_variable_name_from_reference(var_elem, resolver)
         else:
             var_name = "?"
 
-        expr_elem = node.find(".//expression")
-        expr_val = "?"
-        if expr_elem is not None:
-            parts = []
-            for child in expr_elem:
-                if child.tag == "ExpressionChar":
-                    parts.append(child.attrib.get("character", ""))
-                elif child.tag == "ExpressionToken":
-                    parts.append(child.attrib.get("token", "").strip())
-                elif child.tag == "ExpressionVariable":
-                    var_node = next(iter(child), None)  # ProgramVariable, InstallationVariable, etc.
-                    if var_node is not None:
-                        name = var_node.attrib.get("name")
-                        if name is None and "reference" in var_node.attrib:
-                            name = resolve_variable_name_from_reference(var_node)
-                        parts.append(name or "?")
-                    else:
-                        parts.append("?")
-                elif child.tag == "ExpressionGeomFeature":
-                    feature_elem = child.find(".//feature")
-                    if feature_elem is not None:
-                        ref_name = feature_elem.attrib.get("referencedName", "?")
-                        parts.append(ref_name)
-                    else:
-                        parts.append("?")
-                else:
-                    parts.append("?")  # fallback
-            expr_val = "".join(parts).strip()
-
+        expr_val = expressions.render(node.find(".//expression"))
         displaytext = f"{var_name} = {expr_val}"
+        # A <variable> without a readable name names nothing
+        if facts is not None and _is_known_name(var_name):
+            facts.append(("variable", var_name))
 
 
 
@@ -126,16 +349,14 @@ def parse_node_structured(node, root, depth=0):
         displaytext = "Initialize Variables"
         for var in node.findall(".//variable"):
             var_name = var.attrib.get("name", "?")
-            expr_chars = var.findall(".//ExpressionChar")
-            expr_val = "".join(c.attrib.get("character", "") for c in expr_chars)
-            children.append({
-                "type": "InitVariable",
-                "name": var_name,
-                "motion_type": "",
-                "displaytext": f"{var_name} = {expr_val}",
-                "depth": depth + 1,
-                "children": []
-            })
+            expr_val = expressions.render_descendants(var)
+            children.append(ProgramNode(
+                "InitVariable",
+                f"{var_name} = {expr_val}",
+                depth + 1,
+                name=var_name,
+                motion_type=""
+            ))
 
     elif tag == "CallSubProgram":
         sub_elem = node.find(".//subprogram")
@@ -145,33 +366,36 @@ def parse_node_structured(node, root, depth=0):
                 displaytext = f"{sub_name}"
             else:
                 ref = sub_elem.attrib.get("reference", "")
-                resolved_name = resolve_subprogram_name(ref, sub_elem)
+                resolved_name = resolve_subprogram_name(ref, sub_elem, resolver)
                 displaytext = resolved_name if resolved_name else f"(ref): {ref}"
+                sub_name = resolved_name
+            if sub_name and facts is not None:
+                facts.append(("subprogram", sub_name))
         else:
             displaytext = "[Missing <subprogram>]"
 
     elif tag == "SubProgram":
         ref = node.attrib.get("reference")
-        if ref:
-            resolved = node.xpath(ref)
-            if resolved:
-                target = resolved[0]
-                name = target.attrib.get("name", "[anonymous]")
-                displaytext = name
-                children = [
-                    parsed for child in target.findall("./children/*")
-                    if (parsed := parse_node_structured(child, root, depth + 1)) is not None
-                ]
-            else:
-                displaytext = f"(unresolved): {ref}"
-                children = []
+        target = resolver.resolve(node, ref) if ref else node
+        if target is not None:
+            displaytext = target.attrib.get("name", "[anonymous]")
+            if facts is not None:
+                facts.append(("subprogram", displaytext))
+
+            # Each subprogram body is parsed once; later occurrences share
+            # the parsed children and are flagged as references.
+            shared = subprograms.get(target)
+            if shared is not None:
+                return ProgramNode(tag, displaytext, depth, shared.children, is_reference=True), NO_CHILDREN, root
+
+            # Subprogram bodies always get their own list: its identity is
+            # what shared occurrences are matched on.
+            parsed_node = ProgramNode(tag, displaytext, depth, [])
+            subprograms[target] = parsed_node
+            return parsed_node, target.findall("./children/*"), root
         else:
-            name = node.attrib.get("name", "[anonymous]")
-            displaytext = name
-            children = [
-                parsed for child in node.findall("./children/*")
-                if (parsed := parse_node_structured(child, root, depth + 1)) is not None
-            ]
+            displaytext = f"(unresolved): {ref}"
+            children = []
 
 
     elif tag == "Move":
@@ -185,23 +409,7 @@ def parse_node_structured(node, root, depth=0):
             displaytext = file_path
         elif script_type == "Line":
             expr_elem = node.find(".//expression")
-            expr_parts = []
-
-            if expr_elem is not None:
-                for child in expr_elem:
-                    if child.tag == "ExpressionChar":
-                        expr_parts.append(child.attrib.get("character", ""))
-                    elif child.tag == "ExpressionVariable":
-                        progvar = child.find(".//ProgramVariable")
-                        if progvar is not None:
-                            var_name = resolve_variable_name_from_reference(progvar)
-                            expr_parts.append(var_name)
-                        else:
-                            expr_parts.append("?")
-                    else:
-                        expr_parts.append("?")
-            expr_val = "".join(expr_parts)
-            displaytext = expr_val
+            displaytext = expressions.render(expr_elem) if expr_elem is not None else ""
         else:
             displaytext = f"[Unknown type: {script_type}]"
 
@@ -211,8 +419,7 @@ def parse_node_structured(node, root, depth=0):
             tag = "Else"
             displaytext = "Else"
         else:
-            expr_elem = node.find(".//expression")
-            displaytext = parse_expression(expr_elem)
+            displaytext = expressions.render(node.find(".//expression"))
 
 
 
@@ -223,11 +430,8 @@ def parse_node_structured(node, root, depth=0):
             count = node.attrib.get("count", "?")
             displaytext = f"{count} Times"
         else:
-            token_elem = node.find(".//ExpressionToken")
-            token = token_elem.attrib.get("token", "").strip() if token_elem is not None else ""
-            progvar_elem = node.find(".//ProgramVariable")
-            var_name = resolve_variable_name_from_reference(progvar_elem) if progvar_elem is not None else "?"
-            displaytext = f"{loop_type} ({token} {var_name})".strip()
+            expr_elem = node.find("expression")
+            displaytext = f"{loop_type} ({expressions.render(expr_elem)})" if expr_elem is not None else loop_type
 
 
     elif tag == "Wait":
@@ -238,11 +442,7 @@ def parse_node_structured(node, root, depth=0):
             displaytext = f"{wait_time}s"
         else:
             expr_elem = node.find(".//expression")
-            token_elem = expr_elem.find(".//ExpressionToken") if expr_elem is not None else None
-            expr_chars = expr_elem.findall(".//ExpressionChar") if expr_elem is not None else []
-            token = token_elem.attrib.get("token", "").strip() if token_elem is not None else ""
-            suffix = "".join(c.attrib.get("character", "") for c in expr_chars)
-            displaytext = token + suffix if token or suffix else "?"
+            displaytext = (expressions.render(expr_elem) if expr_elem is not None else "") or "?"
 
     elif tag == "SetPayload":
         displaytext = node.attrib.get("workpieceName", "?")
@@ -277,12 +477,15 @@ def parse_node_structured(node, root, depth=0):
             displaytext = "Distance: ?"
 
     elif tag == "Switch":
+        # Labelled with the variable switched on, not the whole expression
         expr_elem = node.find(".//expression")
         progvar = expr_elem.find(".//ProgramVariable") if expr_elem is not None else None
         if progvar is not None:
             var_name = progvar.attrib.get("name")
             if var_name is None and "reference" in progvar.attrib:
-                var_name = resolve_variable_name_from_reference(progvar)
+                var_name = resolve_variable_name_from_reference(progvar, resolver)
+            if _is_known_name(var_name) and expressions.used_variables is not None:
+                expressions.used_variables.append(var_name)
         else:
             var_name = "?"
         displaytext = f"{var_name}"
@@ -304,12 +507,14 @@ def parse_node_structured(node, root, depth=0):
                 elif "reference" in tcp_elem.attrib:
                     ref = tcp_elem.attrib["reference"]
                     try:
-                        resolved = tcp_elem.xpath(ref)
-                        if resolved:
-                            tcp_name = resolved[0].attrib.get("referencedName", "?")
+                        resolved = resolver.resolve(tcp_elem, ref)
+                        if resolved is not None:
+                            tcp_name = resolved.attrib.get("referencedName", "?")
                     except Exception as e:
                         tcp_name = f"(XPath error: {e})"
             displaytext = f"Set TCP: {tcp_name}"
+            if facts is not None and _is_known_name(tcp_name):
+                facts.append(("tcp", tcp_name))
 
         elif set_type == "DigitalOutput":
             pin_elem = node.find("pin")
@@ -322,14 +527,16 @@ def parse_node_structured(node, root, depth=0):
                 elif "reference" in pin_elem.attrib:
                     ref = pin_elem.attrib["reference"]
                     try:
-                        resolved = pin_elem.xpath(ref)
-                        if resolved:
-                            pin_name = resolved[0].attrib.get("referencedName", "?")
+                        resolved = resolver.resolve(pin_elem, ref)
+                        if resolved is not None:
+                            pin_name = resolved.attrib.get("referencedName", "?")
                     except Exception as e:
                         pin_name = f"(XPath error: {e})"
 
             value = val_elem.text.strip() if val_elem is not None and val_elem.text else "?"
             displaytext = f"{pin_name} = {value}"
+            if facts is not None and _is_known_name(pin_name):
+                facts.append(("pin", pin_name))
 
 
 
@@ -340,12 +547,14 @@ def parse_node_structured(node, root, depth=0):
         if var_elem is not None:
             timer_name = var_elem.attrib.get("name")
             if timer_name is None and "reference" in var_elem.attrib:
-                timer_name = resolve_variable_name_from_reference(var_elem)
+                timer_name = resolve_variable_name_from_reference(var_elem, resolver)
             if timer_name is None:
                 timer_name = "?"
         else:
             timer_name = "?"
         displaytext = f"{action} Timer: {timer_name}"
+        if facts is not None and _is_known_name(timer_name):
+            facts.append(("variable", timer_name))
     elif tag == "Popup":
         message = node.attrib.get("message", "?")
         displaytext = message
@@ -353,16 +562,8 @@ def parse_node_structured(node, root, depth=0):
     else:
         displaytext = name or ""
 
+    child_elements = NO_CHILDREN
     if tag != "InitVariablesNode" and not children:
-        children = [
-            parsed for child in node.findall("./children/*")
-            if (parsed := parse_node_structured(child, root, depth + 1)) is not None
-        ]
-
-
-    return {
-        "type": tag,
-        "displaytext": displaytext,
-        "depth": depth,
-        "children": children
-    }
\ No newline at end of file
+        child_elements = node.findall("./children/*")
+
+    return ProgramNode(tag, displaytext, depth, children or NO_CHILDREN), child_elements, root
\ No newline at end of file
@@ -0,0 +1,317 @@
+# Layout constants
+VERTICAL_SPACING = 120
+HORIZONTAL_SPACING = 250
+NODE_WIDTH = 180
+NODE_HEIGHT = 70
+SECTION_SPACING = 300
+COLLAPSED_GROUP_HEIGHT = 40
+
+# Free space between two boxes that follow each other
+VERTICAL_GAP = VERTICAL_SPACING - NODE_HEIGHT
+HORIZONTAL_GAP = HORIZONTAL_SPACING - NODE_WIDTH
+GROUP_PADDING = 20
+
+GROUP_TYPES = ("Folder", "Thread")
+
+# How a cell's drawn children are arranged
+STACK = "stack"
+BRANCHES = "branches"
+GROUP = "group"
+
+# Type of the cells standing in for nodes a LevelOfDetail leaves out
+SUMMARY_TYPE = "Collapsed"
+# Sibling types whose runs LevelOfDetail(collapse_runs=True) draws as one cell
+RUN_KINDS = {"Move": "motion", "Waypoint": "motion", "InitVariable": "variables"}
+
+
+class LayoutCell:
+    """One box of the diagram, positioned in absolute coordinates.
+
+    `left`, `right` and `extent_height` describe the bounding box of the
+    cell's whole drawn subtree relative to its own top-left corner.
+    `is_reference` marks a subprogram occurrence drawn as a link to the
+    cell drawing its body.
+    """
+
+    __slots__ = ("node", "arrangement", "role", "children", "x", "y", "width", "height", "left", "right", "extent_height", "is_reference")
+
+    def __init__(self, node, arrangement, role=None, width=NODE_WIDTH, height=NODE_HEIGHT):
+        self.node = node
+        self.arrangement = arrangement
+        self.role = role
+        self.children = []
+        self.x = 0
+        self.y = 0
+        self.width = width
+        self.height = height
+        self.left = 0
+        self.right = width
+        self.extent_height = height
+        self.is_reference = False
+
+    @property
+    def is_group(self):
+        return self.arrangement == GROUP
+
+
+class LevelOfDetail:
+    """What `layout_program` draws of each section.
+
+    Below `max_depth` levels, and past the first `max_children` children of
+    a node, nodes are replaced by one summary cell counting them by type.
+    With `collapse_runs`, every run of two or more Move/Waypoint or
+    InitVariable siblings becomes a summary cell as well.
+    """
+
+    def __init__(self, max_depth=None, max_children=None, collapse_runs=False):
+        self.max_depth = max_depth
+        self.max_children = max_children
+        self.collapse_runs = collapse_runs
+
+    def drawn_children(self, children, depth):
+        """`children` of a node `depth` levels below its section, with the
+        nodes left out replaced by summary nodes."""
+        if not children:
+            return children
+        if self.max_depth is not None and depth >= self.max_depth:
+            return [summarize(children)]
+        if self.collapse_runs:
+            drawn = []
+            run = []
+            for child in children:
+                kind = RUN_KINDS.get(child["type"])
+                if run and kind != RUN_KINDS[run[0]["type"]]:
+                    drawn.extend(run if len(run) == 1 else [summarize(run)])
+                    run = []
+                if kind is None:
+                    drawn.append(child)
+                else:
+                    run.append(child)
+            if run:
+                drawn.extend(run if len(run) == 1 else [summarize(run)])
+            children = drawn
+        if self.max_children is not None and len(children) > self.max_children:
+            children = children[:self.max_children] + [summarize(children[self.max_children:])]
+        return children
+
+    def __repr__(self):
+        return f"LevelOfDetail(max_depth={self.max_depth}, max_children={self.max_children}, collapse_runs={self.collapse_runs})"
+
+
+def summarize(nodes):
+    """Summary node standing in for `nodes` and their subtrees; its
+    `counts` maps node types to how many of them it hides."""
+    counts = {}
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        if node["type"] == SUMMARY_TYPE:
+            # Already summarized by an enclosing limit
+            for node_type, count in node["counts"].items():
+                counts[node_type] = counts.get(node_type, 0) + count
+            continue
+        counts[node["type"]] = counts.get(node["type"], 0) + 1
+        if not node.get("is_reference"):
+            stack.extend(node.get("children", ()))
+    counts = dict(sorted(counts.items(), key=lambda item: -item[1]))
+    total = sum(counts.values())
+    return {"type": SUMMARY_TYPE, "displaytext": f"{total} node{'s' if total != 1 else ''}", "counts": counts}
+
+
+class ProgramLayout:
+    """Cells in drawing order (groups before their contents) and edges as
+    `(source index, target index, kind)`, kind being one of "next", "yes",
+    "no" or "reference"."""
+
+    def __init__(self):
+        self.cells = []
+        self.edges = []
+
+
+def node_height(node):
+    if node["type"] == "Move":
+        waypoints = sum(1 for child in node.get("children", []) if child["type"] == "Waypoint")
+        if waypoints:
+            return max(NODE_HEIGHT, 30 + 20 * waypoints)
+    return NODE_HEIGHT
+
+
+def layout_program(root_node, detail=None, linked=()):
+    """Tidy layout of a parsed program in O(n).
+
+    Sequences are stacked below their parent, the branches of an If sit to
+    its right (Yes) and left (No), and Folder/Thread sections become groups
+    sized to their contents. Subtree extents are computed bottom-up and
+    positions assigned top-down, so no two boxes overlap. A `LevelOfDetail`
+    limits what is drawn; left out nodes are drawn as summary cells.
+
+    A shared subprogram body is drawn once, at the first of its occurrences
+    that is drawn, and the others link to it. References to the subprograms
+    named in `linked` (drawn on another page) are never expanded.
+    """
+    layout = ProgramLayout()
+    cells = layout.cells
+    title = LayoutCell(
+        {"type": "URProgram", "displaytext": root_node["displaytext"]}, STACK,
+        width=NODE_WIDTH * 2, height=NODE_HEIGHT * 1.5,
+    )
+    cells.append(title)
+
+    # Cell index of drawn subprogram bodies, keyed by the shared children list
+    subprogram_cells = {}
+    # Reference cells met before any drawn occurrence of their body
+    waiting = {}
+    sections = [_collect([(child, None, None, 0)], layout, subprogram_cells, waiting, detail, linked) for child in root_node.get("children", [])]
+
+    # A body whose parsed occurrence is not drawn (a later If child, or
+    # folded away by `detail`) is drawn at its first drawn reference instead
+    while waiting:
+        body = next(iter(waiting))
+        references = waiting.pop(body)
+        target = subprogram_cells.get(body)
+        if target is None:
+            (target, depth), references = references[0], references[1:]
+            subprogram_cells[body] = target
+            cell = cells[target]
+            cell.is_reference = False
+            _collect(_child_entries(cell, target, depth, detail), layout, subprogram_cells, waiting, detail, linked)
+        layout.edges.extend((index, target, "reference") for index, _ in references)
+
+    for cell in reversed(cells):
+        _measure(cell, cells)
+
+    y = NODE_HEIGHT * 2
+    for i, section in enumerate(sections):
+        cells[section].y = y
+        y += max(SECTION_SPACING, cells[section].extent_height + VERTICAL_SPACING)
+        if i:
+            layout.edges.append((sections[i - 1], section, "next"))
+
+    for cell in cells:
+        _place_children(cell, cells)
+    return layout
+
+
+def _collect(stack, layout, subprogram_cells, waiting, detail=None, linked=()):
+    # Visit the drawn nodes below the (node, parent index, role, depth)
+    # entries of `stack` in pre-order, appending a cell for each and
+    # recording the edges between them. Returns the first new cell index.
+    cells = layout.cells
+    edges = layout.edges
+
+    first_index = len(cells)
+    while stack:
+        node, parent_index, role, depth = stack.pop()
+        index = len(cells)
+
+        if parent_index is None and node["type"] in GROUP_TYPES:
+            cell = LayoutCell(node, GROUP, width=NODE_WIDTH * 2, height=COLLAPSED_GROUP_HEIGHT + GROUP_PADDING)
+        elif node["type"] == SUMMARY_TYPE:
+            cell = LayoutCell(node, STACK, role, height=COLLAPSED_GROUP_HEIGHT)
+        else:
+            cell = LayoutCell(node, BRANCHES if node["type"] == "If" else STACK, role, height=node_height(node))
+        cells.append(cell)
+
+        if parent_index is not None:
+            parent = cells[parent_index]
+            if parent.arrangement == BRANCHES:
+                edges.append((parent_index, index, role))
+            elif parent.children:
+                edges.append((parent.children[-1], index, "next"))
+            elif parent.arrangement == STACK:
+                edges.append((parent_index, index, "next"))
+            parent.children.append(index)
+
+        if node["type"] == "SubProgram" and "children" in node:
+            # Shared subprogram bodies are drawn once; other occurrences
+            # link to that drawing.
+            body = id(node["children"])
+            target = subprogram_cells.get(body)
+            if target is not None or node.get("is_reference"):
+                cell.is_reference = True
+                if target is not None:
+                    edges.append((index, target, "reference"))
+                elif node["displaytext"] not in linked:
+                    waiting.setdefault(body, []).append((index, depth))
+                continue
+            subprogram_cells[body] = index
+
+        stack.extend(_child_entries(cell, index, depth, detail))
+    return first_index
+
+
+def _child_entries(cell, index, depth, detail):
+    # Stack entries of the drawn children of `cell`, last child first
+    children = cell.node.get("children", [])
+    if cell.arrangement == BRANCHES:
+        # Split before `detail` folds anything, so a folded run never takes
+        # the place of the Else and each branch is limited on its own
+        then_children = [c for c in children if c["type"] != "Else"]
+        else_children = [c for c in children if c["type"] == "Else"]
+        if detail is not None:
+            then_children = detail.drawn_children(then_children, depth)
+            else_children = detail.drawn_children(else_children, depth)
+        entries = []
+        if else_children:
+            entries.append((else_children[0], index, "no", depth + 1))
+        if then_children:
+            entries.append((then_children[0], index, "yes", depth + 1))
+        return entries
+    if detail is not None:
+        children = detail.drawn_children(children, depth)
+    return [(child, index, None, depth + 1) for child in reversed(children)]
+
+
+def _measure(cell, cells):
+    # Children are always measured first: they come after their parent in
+    # `cells`, which is walked in reverse.
+    children = [cells[i] for i in cell.children]
+    if not children:
+        return
+    if cell.arrangement == GROUP:
+        inner_width = max(child.left + child.right for child in children)
+        cell.width = max(NODE_WIDTH * 2, inner_width + 2 * GROUP_PADDING)
+        cell.height = (
+            COLLAPSED_GROUP_HEIGHT
+            + sum(child.extent_height for child in children)
+            + VERTICAL_GAP * (len(children) - 1)
+            + GROUP_PADDING
+        )
+        cell.right = cell.width
+        cell.extent_height = cell.height
+    elif cell.arrangement == BRANCHES:
+        for child in children:
+            if child.role == "yes":
+                cell.right = max(cell.right, cell.width + HORIZONTAL_GAP + child.left + child.right)
+            else:
+                cell.left = max(cell.left, HORIZONTAL_GAP + child.left + child.right)
+            cell.extent_height = max(cell.extent_height, child.extent_height)
+    else:
+        cell.left = max(child.left for child in children)
+        cell.right = max(cell.width, max(child.right for child in children))
+        cell.extent_height = cell.height + sum(VERTICAL_GAP + child.extent_height for child in children)
+
+
+def _place_children(cell, cells):
+    # Parents are always placed first: they come before their children.
+    if cell.arrangement == BRANCHES:
+        for i in cell.children:
+            child = cells[i]
+            if child.role == "yes":
+                child.x = cell.x + cell.width + HORIZONTAL_GAP + child.left
+            else:
+                child.x = cell.x - HORIZONTAL_GAP - child.right
+            child.y = cell.y
+        return
+
+    if cell.arrangement == GROUP:
+        x = cell.x + GROUP_PADDING
+        y = cell.y + COLLAPSED_GROUP_HEIGHT
+    else:
+        x = cell.x
+        y = cell.y + cell.height + VERTICAL_GAP
+    for i in cell.children:
+        child = cells[i]
+        child.x = x + child.left if cell.arrangement == GROUP else x
+        child.y = y
+        y += child.extent_height + VERTICAL_GAP
@@ -0,0 +1,51 @@
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+
+def run_jobs(function, jobs, workers=None, mp_context=None):
+    """Call `function(*args)` for each `(key, args)` of `jobs` on a process
+    pool and yield `(key, result, error)` as the calls finish, `error` being
+    the exception a call raised or None.
+
+    At most `workers` calls (default: one per CPU) are in flight at a time.
+    A worker dying outright (e.g. out of memory) breaks the whole pool:
+    the calls not started yet go on in a new pool, and the ones that were in
+    flight are each retried once on a pool of their own, so only a call
+    that crashes its worker again is reported, with a `BrokenProcessPool`.
+    """
+    workers = workers or os.cpu_count() or 1
+    jobs = deque(jobs)
+    suspects = deque()
+    while jobs or suspects:
+        isolated = not jobs
+        pool_jobs = deque([suspects.popleft()]) if isolated else jobs
+        with ProcessPoolExecutor(max_workers=1 if isolated else workers, mp_context=mp_context) as pool:
+            in_flight = {}
+            broken = False
+            while in_flight or (pool_jobs and not broken):
+                while pool_jobs and not broken and len(in_flight) < workers:
+                    key, args = pool_jobs.popleft()
+                    try:
+                        in_flight[pool.submit(function, *args)] = (key, args)
+                    except BrokenProcessPool:
+                        pool_jobs.appendleft((key, args))
+                        broken = True
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, args = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool as e:
+                        broken = True
+                        if isolated:
+                            yield key, None, e
+                        else:
+                            suspects.append((key, args))
+                    except Exception as e:
+                        yield key, None, e
+                    else:
+                        yield key, result, None
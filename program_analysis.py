@@ -0,0 +1,137 @@
+from collections import deque
+
+
+class ProgramAnalysis:
+    """Subprogram call graph and variable def/use table of one program.
+
+    Filled by `parse_node_structured(..., analysis=ProgramAnalysis())` from
+    the names the node handlers resolve anyway, in the same pass that builds
+    the tree, so the work is linear in the number of nodes. Node ids are the
+    same as those of a `ProgramIndex` filled in the same pass.
+
+    Every node belongs to a scope: the top-level section or the subprogram
+    body it sits in. A CallSubProgram, or a SubProgram occurrence inside
+    another scope, is a call from that scope.
+    """
+
+    def __init__(self):
+        self.nodes = []
+        self.scopes = []  # node id -> id of the scope node it belongs to
+        self.scope_names = {}  # scope node id -> caller name in the call graph
+        self.calls = []  # (caller name, callee name, node id)
+        self.definitions = {}  # variable name -> node ids assigning it
+        self.uses = {}  # variable name -> node ids reading it
+
+    def add(self, node, parent_id, facts=()):
+        node_id = len(self.nodes)
+        self.nodes.append(node)
+        # The root is node 0; its children (the top-level sections) and
+        # subprogram bodies open their own scope
+        opens_scope = parent_id is None or parent_id == 0 or (node.type == "SubProgram" and not node.is_reference)
+        self.scopes.append(node_id if opens_scope else self.scopes[parent_id])
+        if opens_scope and parent_id is not None:
+            self.scope_names[node_id] = node.displaytext or node.type
+        calling_scope = self.scopes[parent_id] if parent_id else None
+
+        for kind, name in facts:
+            if kind == "variable":
+                self.definitions.setdefault(name, []).append(node_id)
+            elif kind == "uses":
+                self.uses.setdefault(name, []).append(node_id)
+            elif kind == "subprogram" and calling_scope is not None:
+                self.calls.append((self.scope_names[calling_scope], name, node_id))
+        return node_id
+
+    def call_graph(self):
+        """{caller: sorted callee names}, with every scope as a caller."""
+        graph = {name: set() for name in self.scope_names.values()}
+        for caller, callee, _ in self.calls:
+            graph[caller].add(callee)
+            graph.setdefault(callee, set())
+        return {caller: sorted(callees) for caller, callees in graph.items()}
+
+    def cycles(self):
+        """Groups of subprograms that call each other, directly or not.
+
+        Strongly connected components of the call graph (Tarjan's algorithm,
+        iterative) with more than one member, plus subprograms calling
+        themselves.
+        """
+        graph = self.call_graph()
+        order = {}
+        lowlink = {}
+        on_stack = set()
+        component_stack = []
+        cycles = []
+        for start in graph:
+            if start in order:
+                continue
+            work = [(start, iter(graph[start]))]
+            order[start] = lowlink[start] = len(order)
+            component_stack.append(start)
+            on_stack.add(start)
+            while work:
+                name, callees = work[-1]
+                for callee in callees:
+                    if callee not in order:
+                        order[callee] = lowlink[callee] = len(order)
+                        component_stack.append(callee)
+                        on_stack.add(callee)
+                        work.append((callee, iter(graph[callee])))
+                        break
+                    if callee in on_stack:
+                        lowlink[name] = min(lowlink[name], order[callee])
+                else:
+                    work.pop()
+                    if work:
+                        caller = work[-1][0]
+                        lowlink[caller] = min(lowlink[caller], lowlink[name])
+                    if lowlink[name] == order[name]:
+                        component = []
+                        while True:
+                            member = component_stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == name:
+                                break
+                        if len(component) > 1 or name in graph[name]:
+                            cycles.append(sorted(component))
+        return cycles
+
+    def call_depths(self):
+        """Shortest call distance of every call graph node from a top-level
+        section; subprograms nobody reaches get None."""
+        graph = self.call_graph()
+        depths = {name: None for name in graph}
+        queue = deque()
+        for scope_id, name in self.scope_names.items():
+            if self.nodes[scope_id].type != "SubProgram":
+                depths[name] = 0
+                queue.append(name)
+        while queue:
+            name = queue.popleft()
+            for callee in graph[name]:
+                if depths[callee] is None:
+                    depths[callee] = depths[name] + 1
+                    queue.append(callee)
+        return depths
+
+    def variable_table(self):
+        """One row per variable: where it is assigned and where it is read."""
+        return [
+            {
+                "variable": name,
+                "assigned": len(self.definitions.get(name, ())),
+                "read": len(self.uses.get(name, ())),
+                "assigned_at": self.definitions.get(name, []),
+                "read_at": self.uses.get(name, []),
+            }
+            for name in sorted(set(self.definitions) | set(self.uses))
+        ]
+
+    def to_dict(self):
+        return {
+            "call_graph": self.call_graph(),
+            "cycles": self.cycles(),
+            "variables": self.variable_table(),
+        }
@@ -0,0 +1,162 @@
+from difflib import SequenceMatcher
+from hashlib import blake2b
+
+INSERTED = "inserted"
+DELETED = "deleted"
+MOVED = "moved"
+CHANGED = "changed"
+
+
+class SubtreeHashes(dict):
+    """{id(node): digest} of one tree, as `subtree_hashes` returns it.
+
+    Node ids do not survive pickling, so it pickles as its tree and is
+    rehashed when loaded; a result cache can keep it next to the tree.
+    """
+
+    __slots__ = ("root",)
+
+    def __reduce__(self):
+        return subtree_hashes, (self.root,)
+
+
+def subtree_hashes(root):
+    """Merkle-style digest of every subtree below `root`, keyed by node id.
+
+    A node's BLAKE2b digest covers its type, its displaytext and its
+    children's digests, but not its depth, so equal subtrees hash equal
+    wherever they sit. Shared subprogram references hash without their
+    body, which is hashed once at its SubProgram definition.
+    """
+    hashes = SubtreeHashes()
+    hashes.root = root
+    stack = [(root, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if children_done:
+            digest = blake2b(digest_size=16)
+            for text in (node.type, node.displaytext or ""):
+                data = text.encode()
+                digest.update(len(data).to_bytes(4, "little"))
+                digest.update(data)
+            for child in _children(node):
+                digest.update(hashes[id(child)])
+            hashes[id(node)] = digest.digest()
+            continue
+        if id(node) in hashes:
+            continue
+        stack.append((node, True))
+        for child in _children(node):
+            stack.append((child, False))
+    return hashes
+
+
+def _children(node):
+    return () if node.is_reference else node.children
+
+
+def _label(node):
+    return f"{node.type}: {node.displaytext}" if node.displaytext else node.type
+
+
+def _entry(kind, node, old_path=None, new_path=None, old_text=None, new_text=None):
+    return {
+        "kind": kind,
+        "type": node.type,
+        "old_path": old_path,
+        "new_path": new_path,
+        "old_text": old_text,
+        "new_text": new_text,
+    }
+
+
+def diff_programs(old_root, new_root, old_hashes=None, new_hashes=None):
+    """Compare two trees from `parse_node_structured`.
+
+    Returns a list of change dicts with `kind` ("inserted", "deleted",
+    "moved" or "changed"), the node `type`, `old_path`/`new_path` (the
+    " > "-joined labels of the node and its ancestors, None on the side the
+    node is missing from) and `old_text`/`new_text` for changed nodes.
+
+    Subtrees whose hashes match are skipped without being walked, so once
+    the hashes are known (pass them in to reuse them) the work is
+    proportional to the size of the change. A deleted subtree that is
+    inserted unchanged elsewhere is reported once, as moved.
+    """
+    if old_hashes is None:
+        old_hashes = subtree_hashes(old_root)
+    if new_hashes is None:
+        new_hashes = subtree_hashes(new_root)
+
+    changes = []
+    deleted = {}  # subtree hash -> [(node, path)] removed from the old tree
+    inserted = {}  # subtree hash -> [(node, path)] added to the new tree
+
+    stack = [(old_root, new_root, _label(old_root), _label(new_root))]
+    while stack:
+        old, new, old_path, new_path = stack.pop()
+        if old_hashes[id(old)] == new_hashes[id(new)]:
+            continue
+        if old.displaytext != new.displaytext:
+            changes.append(_entry(CHANGED, new, old_path, new_path, old.displaytext, new.displaytext))
+
+        old_children = _children(old)
+        new_children = _children(new)
+        matcher = SequenceMatcher(
+            None,
+            [old_hashes[id(child)] for child in old_children],
+            [new_hashes[id(child)] for child in new_children],
+            autojunk=False,
+        )
+        pairs = []
+        for tag, o1, o2, n1, n2 in matcher.get_opcodes():
+            if tag == "equal":
+                continue
+            # Children of the same type at the same position inside a
+            # replaced block are compared in depth, the rest are removed or
+            # added whole.
+            paired = min(o2 - o1, n2 - n1) if tag == "replace" else 0
+            for offset in range(paired):
+                old_child = old_children[o1 + offset]
+                new_child = new_children[n1 + offset]
+                if old_child.type == new_child.type:
+                    pairs.append((old_child, new_child))
+                else:
+                    deleted.setdefault(old_hashes[id(old_child)], []).append((old_child, f"{old_path} > {_label(old_child)}"))
+                    inserted.setdefault(new_hashes[id(new_child)], []).append((new_child, f"{new_path} > {_label(new_child)}"))
+            for old_child in old_children[o1 + paired:o2]:
+                deleted.setdefault(old_hashes[id(old_child)], []).append((old_child, f"{old_path} > {_label(old_child)}"))
+            for new_child in new_children[n1 + paired:n2]:
+                inserted.setdefault(new_hashes[id(new_child)], []).append((new_child, f"{new_path} > {_label(new_child)}"))
+
+        # Reversed, so changes come out in program order
+        for old_child, new_child in reversed(pairs):
+            stack.append((old_child, new_child, f"{old_path} > {_label(old_child)}", f"{new_path} > {_label(new_child)}"))
+
+    for subtree_hash, removed in deleted.items():
+        added = inserted.get(subtree_hash, [])
+        for (node, old_path), (_, new_path) in zip(removed, added):
+            changes.append(_entry(MOVED, node, old_path, new_path))
+        moved = min(len(removed), len(added))
+        for node, old_path in removed[moved:]:
+            changes.append(_entry(DELETED, node, old_path=old_path))
+        del added[:moved]
+    for added in inserted.values():
+        for node, new_path in added:
+            changes.append(_entry(INSERTED, node, new_path=new_path))
+    return changes
+
+
+def format_diff(changes):
+    """One line per change, in a diff-like notation."""
+    lines = []
+    for change in changes:
+        if change["kind"] == INSERTED:
+            lines.append(f"+ {change['new_path']}")
+        elif change["kind"] == DELETED:
+            lines.append(f"- {change['old_path']}")
+        elif change["kind"] == MOVED:
+            lines.append(f"> {change['old_path']}\n    -> {change['new_path']}")
+        else:
+            lines.append(f"~ {change['new_path']}\n    was: {change['old_text']}")
+    return "\n".join(lines)
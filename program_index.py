@@ -0,0 +1,100 @@
+import re
+from bisect import bisect_left
+
+KINDS = ("variable", "uses", "subprogram", "pin", "tcp")
+
+_TOKEN = re.compile(r"\w+")
+
+
+class ProgramIndex:
+    """Inverted index over the nodes of one parsed program.
+
+    Filled by `parse_node_structured(..., index=ProgramIndex())` in the same
+    pass that builds the tree. Node ids are positions in document order.
+    Names of variables (assigned or initialized), variables read (`uses`),
+    subprograms (defined or called), I/O pins and TCPs are indexed per
+    kind, and every word of a node's displaytext as a token. All keys are
+    matched case-insensitively.
+    """
+
+    def __init__(self):
+        self.nodes = []
+        self.parents = []
+        self.names = {kind: {} for kind in KINDS}
+        self.tokens = {}
+        self._sorted_tokens = None
+
+    def add(self, node, parent_id, facts=()):
+        """Index `node` with the (kind, name) pairs in `facts`; returns its id."""
+        node_id = len(self.nodes)
+        self.nodes.append(node)
+        self.parents.append(parent_id)
+        for kind, name in facts:
+            self.names[kind].setdefault(name.lower(), []).append(node_id)
+        tokens = self.tokens
+        for token in set(_TOKEN.findall(f"{node.type} {node.displaytext}".lower())):
+            ids = tokens.get(token)
+            if ids is None:
+                tokens[token] = [node_id]
+            else:
+                ids.append(node_id)
+        self._sorted_tokens = None
+        return node_id
+
+    def find(self, kind, name):
+        """Ids of the nodes referring to `name` as a `kind`, in document order."""
+        return list(self.names[kind].get(name.lower(), ()))
+
+    def search(self, query, limit=None):
+        """Ids of the nodes matching every term of `query`, in document order.
+
+        A term is `kind:name` (e.g. `variable:counter`, `pin:digital_out[2]`)
+        or a word of the displaytext; a word ending in `*` matches as a
+        prefix.
+        """
+        matches = None
+        for term in query.split():
+            ids = set(self._term_ids(term))
+            matches = ids if matches is None else matches & ids
+            if not matches:
+                return []
+        result = sorted(matches or ())
+        return result[:limit] if limit is not None else result
+
+    def _term_ids(self, term):
+        kind, _, name = term.partition(":")
+        if name and kind.lower() in self.names:
+            return self.names[kind.lower()].get(name.lower(), ())
+        term = term.lower()
+        if not term.endswith("*"):
+            return self.tokens.get(term, ())
+        prefix = term[:-1]
+        if self._sorted_tokens is None:
+            self._sorted_tokens = sorted(self.tokens)
+        ids = []
+        position = bisect_left(self._sorted_tokens, prefix)
+        while position < len(self._sorted_tokens) and self._sorted_tokens[position].startswith(prefix):
+            ids.extend(self.tokens[self._sorted_tokens[position]])
+            position += 1
+        return ids
+
+    def path(self, node_id):
+        """The nodes from the top of the program down to `node_id`."""
+        path = []
+        while node_id is not None:
+            path.append(self.nodes[node_id])
+            node_id = self.parents[node_id]
+        path.reverse()
+        return path
+
+    def describe(self, node_id):
+        """`node_id`'s path as " > "-joined "Type: text" labels."""
+        return " > ".join(
+            f"{node.type}: {node.displaytext}" if node.displaytext else node.type
+            for node in self.path(node_id)
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_sorted_tokens"] = None
+        return state
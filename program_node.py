@@ -0,0 +1,68 @@
+import sys
+
+# Shared by every leaf node instead of allocating an empty list per node
+NO_CHILDREN = ()
+
+_ALWAYS_PRESENT = frozenset(("type", "displaytext", "depth", "children"))
+
+
+class ProgramNode:
+    """A parsed program node.
+
+    Uses __slots__ and interned type strings so programs with hundreds of
+    thousands of nodes stay small in memory. Read access also works like the
+    dicts `parse_node_structured` used to return (`node["type"]`,
+    `node.get("is_reference")`, `"children" in node`, `node.items()`).
+    """
+
+    __slots__ = ("type", "displaytext", "depth", "children", "name", "motion_type", "is_reference")
+
+    def __init__(self, type, displaytext, depth, children=NO_CHILDREN, name=None, motion_type=None, is_reference=False):
+        self.type = sys.intern(type)
+        self.displaytext = displaytext
+        self.depth = depth
+        self.children = children
+        self.name = name
+        self.motion_type = motion_type
+        self.is_reference = is_reference
+
+    def keys(self):
+        keys = ["type", "displaytext", "depth", "children"]
+        if self.name is not None:
+            keys += ["name", "motion_type"]
+        if self.is_reference:
+            keys.append("is_reference")
+        return keys
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def __contains__(self, key):
+        if key in _ALWAYS_PRESENT:
+            return True
+        if key == "is_reference":
+            return self.is_reference
+        return key in ("name", "motion_type") and self.name is not None
+
+    def __getitem__(self, key):
+        if key in self:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return getattr(self, key)
+        return default
+
+    def to_dict(self):
+        """Plain nested dicts, the shape `parse_node_structured` used to return.
+
+        Shared subprogram references are not expanded (their children are
+        emitted as an empty list), which also keeps recursive programs finite.
+        """
+        data = dict(self.items())
+        data["children"] = [] if self.is_reference else [child.to_dict() for child in self.children]
+        return data
+
+    def __repr__(self):
+        return f"ProgramNode({self.type!r}, {self.displaytext!r}, depth={self.depth}, children={len(self.children)})"
@@ -0,0 +1,256 @@
+import mmap
+import os
+import struct
+from collections.abc import Sequence
+
+from program_node import NO_CHILDREN, ProgramNode
+
+MAGIC = b"URPT"
+FORMAT_VERSION = 2
+# Bump whenever `parse_node_structured` turns the same .urp into a
+# different tree, so that sidecars written by older code are reparsed
+PARSER_VERSION = 1
+SIDECAR_SUFFIX = ".urpt"
+
+# magic, format version, parser version, string count, node count,
+# string data size, source size, source mtime (ns)
+_HEADER = struct.Struct("<4sHHIIIQq")
+# type, displaytext, name, motion type (string indices), depth,
+# first child index, child count, flags
+_NODE = struct.Struct("<7IB3x")
+_OFFSET = struct.Struct("<I")
+_NONE = 0xFFFFFFFF
+_IS_REFERENCE = 1
+
+
+def dump_program_tree(root, source_stat=None):
+    """Serialize a `parse_node_structured` tree to the binary tree format.
+
+    Strings are stored once in a table. Nodes are laid out breadth-first in
+    one flat array, so every children list is a contiguous run of nodes
+    given by its first index and length. Shared subprogram bodies are
+    written once and referenced by every occurrence.
+
+    `source_stat`, the `os.stat` of the .urp the tree was parsed from, is
+    recorded in the header so a sidecar can be checked against its source.
+    """
+    string_index = {}
+    strings = []
+
+    def intern(value):
+        if value is None:
+            return _NONE
+        index = string_index.get(value)
+        if index is None:
+            index = string_index[value] = len(strings)
+            strings.append(value.encode("utf-8"))
+        return index
+
+    nodes = [root]
+    list_starts = {}  # id(children list) -> index of its first node
+    records = []
+    for node in nodes:  # grows while iterating: breadth-first
+        children = node.children
+        start = 0
+        if children:
+            start = list_starts.get(id(children))
+            if start is None:
+                start = list_starts[id(children)] = len(nodes)
+                nodes.extend(children)
+        records.append(_NODE.pack(
+            intern(node.type),
+            intern(node.displaytext),
+            intern(node.name),
+            intern(node.motion_type),
+            node.depth,
+            start,
+            len(children),
+            _IS_REFERENCE if node.is_reference else 0,
+        ))
+
+    offsets = [0]
+    for data in strings:
+        offsets.append(offsets[-1] + len(data))
+    blob = b"".join(strings)
+    padding = b"\0" * (-len(blob) % 4)
+    return b"".join([
+        _HEADER.pack(
+            MAGIC, FORMAT_VERSION, PARSER_VERSION, len(strings), len(records), len(blob),
+            *_source_stamp(source_stat),
+        ),
+        struct.pack(f"<{len(offsets)}I", *offsets),
+        blob,
+        padding,
+        *records,
+    ])
+
+
+def _source_stamp(source_stat):
+    if source_stat is None:
+        return 0, 0
+    return source_stat.st_size, source_stat.st_mtime_ns
+
+
+def write_program_tree(root, path, source_stat=None):
+    """Write the binary tree of `root` to `path`, replacing it atomically."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(dump_program_tree(root, source_stat))
+    os.replace(tmp_path, path)
+
+
+def load_program_tree(path):
+    """Memory-map a binary tree file and return its root node.
+
+    Only the header is read up front. Nodes are decoded the first time they
+    are reached through their parent's `children`, so opening a file costs
+    the same whatever its size. The returned nodes are ProgramNodes and work
+    with the text renderer, the draw.io exporter and the diff as they are.
+    """
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return _StoredTree(buffer).root()
+
+
+def loads_program_tree(data):
+    """Like `load_program_tree`, for the bytes of a binary tree."""
+    return _StoredTree(data).root()
+
+
+def sidecar_path(urp_path):
+    return urp_path + SIDECAR_SUFFIX
+
+
+def is_current_sidecar(tree_path, source_stat):
+    """Whether the tree file at `tree_path` was written by this parser from
+    a source of exactly the size and mtime in `source_stat`."""
+    try:
+        with open(tree_path, "rb") as f:
+            header = f.read(_HEADER.size)
+    except OSError:
+        return False
+    if len(header) < _HEADER.size:
+        return False
+    magic, version, parser_version, _, _, _, size, mtime_ns = _HEADER.unpack(header)
+    return (
+        magic == MAGIC
+        and version == FORMAT_VERSION
+        and parser_version == PARSER_VERSION
+        and (size, mtime_ns) == _source_stamp(source_stat)
+    )
+
+
+def load_or_parse(urp_path, write_sidecar=True):
+    """Root node of the program in `urp_path`, from its sidecar if that was
+    written from this very file (same size and mtime) by this parser;
+    otherwise the .urp is parsed and (optionally) the sidecar written next
+    to it. Returns None if the file holds no <URProgram>."""
+    from expression_parser import parse_node_structured
+    from urp_loader import load_urprogram
+
+    tree_path = sidecar_path(urp_path)
+    # Stat before parsing: a file changed meanwhile then gets a sidecar
+    # that does not match it and is parsed again next time
+    source_stat = os.stat(urp_path)
+    if is_current_sidecar(tree_path, source_stat):
+        try:
+            return load_program_tree(tree_path)
+        except (OSError, ValueError):
+            pass
+
+    root = load_urprogram(urp_path)
+    if root is None:
+        return None
+    structured_root = parse_node_structured(root, root)
+    if write_sidecar:
+        try:
+            write_program_tree(structured_root, tree_path, source_stat)
+        except OSError:
+            pass  # read-only location; parsing still worked
+    return structured_root
+
+
+class _StoredTree:
+    """Decodes nodes and strings of one binary tree on demand."""
+
+    def __init__(self, buffer):
+        if len(buffer) < _HEADER.size:
+            raise ValueError("not a program tree file (too short)")
+        magic, version, _, string_count, node_count, blob_size, _, _ = _HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("not a program tree file")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"unsupported program tree version {version} (expected {FORMAT_VERSION})")
+
+        self.buffer = buffer
+        self.offsets_start = _HEADER.size
+        self.blob_start = self.offsets_start + (string_count + 1) * _OFFSET.size
+        self.nodes_start = self.blob_start + blob_size + (-blob_size % 4)
+        if len(buffer) < self.nodes_start + node_count * _NODE.size:
+            raise ValueError("program tree file is truncated")
+        self.node_count = node_count
+        self.strings = [None] * string_count
+        # Children sequences by first node index, so shared bodies (and
+        # repeated accesses) get the same object, as in a parsed tree
+        self.child_lists = {}
+
+    def string(self, index):
+        if index == _NONE:
+            return None
+        value = self.strings[index]
+        if value is None:
+            start, end = struct.unpack_from("<2I", self.buffer, self.offsets_start + index * _OFFSET.size)
+            value = self.strings[index] = str(self.buffer[self.blob_start + start:self.blob_start + end], "utf-8")
+        return value
+
+    def node(self, index):
+        type_index, text_index, name_index, motion_index, depth, start, count, flags = _NODE.unpack_from(
+            self.buffer, self.nodes_start + index * _NODE.size
+        )
+        children = NO_CHILDREN
+        if count:
+            children = self.child_lists.get(start)
+            if children is None:
+                children = self.child_lists[start] = _StoredChildren(self, start, count)
+        return ProgramNode(
+            self.string(type_index),
+            self.string(text_index),
+            depth,
+            children,
+            name=self.string(name_index),
+            motion_type=self.string(motion_index),
+            is_reference=bool(flags & _IS_REFERENCE),
+        )
+
+    def root(self):
+        if not self.node_count:
+            raise ValueError("program tree file holds no nodes")
+        return self.node(0)
+
+
+class _StoredChildren(Sequence):
+    """Read-only children list whose nodes are decoded on first access."""
+
+    __slots__ = ("_tree", "_start", "_nodes")
+
+    def __init__(self, tree, start, count):
+        self._tree = tree
+        self._start = start
+        self._nodes = [None] * count
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self._nodes)))]
+        node = self._nodes[index]
+        if node is None:
+            if index < 0:
+                index += len(self._nodes)
+            node = self._nodes[index] = self._tree.node(self._start + index)
+        return node
+
+    def __iter__(self):
+        for index in range(len(self._nodes)):
+            yield self[index]
@@ -0,0 +1,116 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 16
+DEFAULT_MAX_DISK_BYTES = 512 * 1024 * 1024
+
+
+def content_key(data):
+    """SHA-256 hex digest of the uploaded bytes, used as the cache key."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResultCache:
+    """Content-addressed cache of conversion results.
+
+    An in-process LRU layer holds up to `max_entries` results. If `disk_dir`
+    is given, results are also pickled there and the least recently used
+    files are evicted once they exceed `max_disk_bytes` in total.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, disk_dir=None, max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @property
+    def hits(self):
+        return self.memory_hits + self.disk_hits
+
+    def get(self, key):
+        """Return `(value, source)` where source is "memory", "disk" or None on a miss."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key], "memory"
+
+        value = self._load_from_disk(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None, None
+            self.disk_hits += 1
+            self._remember(key, value)
+        return value, "disk"
+
+    def put(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+        self._store_on_disk(key, value)
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.pkl")
+
+    def _load_from_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        os.utime(path)  # mark as recently used for eviction
+        return value
+
+    def _store_on_disk(self, key, value):
+        if not self.disk_dir:
+            return
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._disk_path(key))
+        except (OSError, RecursionError, pickle.PicklingError):
+            # Very deep trees may not pickle; the memory layer still works.
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._evict_disk()
+
+    def _evict_disk(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(".pkl"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
@@ -0,0 +1,83 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from lxml import etree
+
+from expression_parser import ExpressionRenderer, ReferenceResolver, _parse_single_node, parse_node_structured
+from program_store import dump_program_tree, loads_program_tree
+
+# The document each worker process parses its sections from
+_worker_root = None
+
+
+def parse_program_parallel(root, workers=None):
+    """`parse_node_structured(root, root)` with the top-level sections
+    (MainProgram, Before Start, SubPrograms, Threads) parsed on `workers`
+    processes (default: one per CPU).
+
+    Every worker gets the whole document as serialized bytes, so references
+    between sections resolve as usual, and sends each parsed section back in
+    the binary tree format. Sections are merged in document order, and
+    subprogram bodies parsed by more than one worker are reduced to the
+    first one, with the later occurrences made references to it, so the
+    result has the same shape as a serial parse. Falls back to the serial
+    parse for a single worker or section.
+    """
+    resolver = ReferenceResolver()
+    parsed_root, sections, _ = _parse_single_node(root, root, 0, resolver, {}, ExpressionRenderer(resolver))
+    workers = min(workers or os.cpu_count() or 1, len(sections))
+    if workers <= 1:
+        return parse_node_structured(root, root)
+
+    document = etree.tostring(root)
+    # spawn: the caller may be a worker thread of a larger process
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_load_document,
+        initargs=(document,),
+    ) as pool:
+        results = list(pool.map(_parse_section, range(len(sections))))
+
+    parsed_root.children = []
+    bodies = {}  # subprogram path in the document -> children of its first parse
+    for data, subprograms in results:
+        section = loads_program_tree(data)
+        parsed_root.children.append(section)
+        for node_path, target_path in subprograms:
+            node = section
+            for position in node_path:
+                node = node.children[position]
+            body = bodies.setdefault(target_path, node.children)
+            if node.children is not body:
+                node.children = body
+                node.is_reference = True
+    return parsed_root
+
+
+def _load_document(document):
+    global _worker_root
+    _worker_root = etree.fromstring(document, etree.XMLParser(recover=True, huge_tree=True))
+
+
+def _parse_section(position):
+    # Runs in a worker: parses section `position` and returns it as a binary
+    # tree, with (child positions, document path of the subprogram) of every
+    # SubProgram node in it
+    root = _worker_root
+    section_element = root.findall("./children/*")[position]
+    subprograms = {}
+    section = parse_node_structured(section_element, root, 1, subprograms=subprograms)
+
+    document = root.getroottree()
+    target_paths = {id(body.children): document.getpath(target) for target, body in subprograms.items()}
+    found = []
+    stack = [(section, ())]
+    while stack:
+        node, path = stack.pop()
+        if node.type == "SubProgram" and id(node.children) in target_paths:
+            found.append((path, target_paths[id(node.children)]))
+        if not node.is_reference:
+            stack.extend((child, path + (i,)) for i, child in enumerate(node.children))
+    return dump_program_tree(section), found
@@ -0,0 +1,161 @@
+# Lines per page of a section; index_sections records where each page starts
+PAGE_SIZE = 500
+
+
+def iter_node_lines(nodes, line_counter=None, inside_init=False, depth_offset=0, expanding=None, checkpoints=None, page_lines=PAGE_SIZE):
+    """Walk `nodes` in text order, yielding `(line number, depth, node)`.
+
+    The line number is None inside InitVariablesNode, whose lines are not
+    numbered. `line_counter` is a one-element list advanced as lines are
+    numbered, so it can be shared across calls. If `checkpoints` is a list,
+    a checkpoint to resume the walk from (see `resume_node_lines`) is
+    appended to it every `page_lines` numbered lines, starting with the
+    first.
+    """
+    if line_counter is None:
+        line_counter = [1]  # Mutable line counter
+    if expanding is None:
+        expanding = set()  # ids of shared subprogram bodies being expanded
+    frames = [[nodes, 0, inside_init, depth_offset, False]]
+    return _walk(frames, line_counter, expanding, checkpoints, page_lines)
+
+
+def resume_node_lines(checkpoint):
+    """`iter_node_lines` from a checkpoint it recorded onwards."""
+    line_number, saved = checkpoint
+    frames = [list(frame) for frame in saved]
+    expanding = {id(frame[0]) for frame in frames if frame[4]}
+    return _walk(frames, [line_number], expanding)
+
+
+def _walk(frames, line_counter, expanding, checkpoints=None, page_lines=PAGE_SIZE):
+    # Explicit stack instead of recursion, so deep programs render too.
+    # Frames are [nodes, index of the next one, inside_init, depth offset,
+    # whether nodes is a shared subprogram body being expanded]; a
+    # checkpoint is a copy of them, O(depth).
+    first_line = line_counter[0]
+    while frames:
+        frame = frames[-1]
+        nodes, index, node_inside_init, node_offset, is_body = frame
+        if index >= len(nodes):
+            frames.pop()
+            if is_body:
+                expanding.discard(id(nodes))
+            continue
+        frame[1] = index + 1
+        node = nodes[index]
+        if node is None:
+            continue
+
+        if not node_inside_init:
+            line_number = line_counter[0]
+            line_counter[0] += 1
+            if checkpoints is not None and (line_number - first_line) % page_lines == 0:
+                checkpoints.append((line_number, tuple(tuple(f) for f in frames[:-1]) + ((nodes, index, node_inside_init, node_offset, is_body),)))
+        else:
+            line_number = None
+
+        yield line_number, node["depth"] + node_offset, node
+
+        # Render children next,
+        # but with `inside_init=True` if current node is InitVariablesNode
+        child_inside_init = node_inside_init or (node["type"] == "InitVariablesNode")
+        children = node["children"]
+        child_offset = node_offset
+        if node.get("is_reference") and children:
+            # Shared subprogram body: expand it here, re-indented relative to
+            # this occurrence, unless it is already being expanded (recursion).
+            if id(children) in expanding:
+                continue
+            child_offset = node["depth"] + node_offset + 1 - children[0]["depth"]
+
+        is_subprogram = node["type"] == "SubProgram"
+        if is_subprogram:
+            expanding.add(id(children))
+        frames.append([children, 0, child_inside_init, child_offset, is_subprogram])
+
+
+def format_line(line_number, depth, node):
+    line_prefix = f"{line_number:>3} | " if line_number is not None else "    | "
+    return f"{line_prefix}{'  ' * depth}- {node['type']}: {node['displaytext']}"
+
+
+def render_node_list(nodes, lines=None, line_counter=None, inside_init=False, depth_offset=0, expanding=None):
+    if lines is None:
+        lines = []
+    for line_number, depth, node in iter_node_lines(nodes, line_counter, inside_init, depth_offset, expanding):
+        lines.append(format_line(line_number, depth, node))
+    return lines
+
+
+def render_program_text(structured_root):
+    """Render every top-level section with one shared line counter."""
+    all_lines = []
+    line_counter = [1]  # shared mutable counter across sections
+
+    # Skip top-level URProgram
+    for section in structured_root["children"]:
+        section_lines = render_node_list([section], line_counter=line_counter)
+        all_lines.extend(section_lines)
+        all_lines.append("")  # visual separation
+
+    return "\n".join(all_lines)
+
+
+def index_sections(structured_root, checkpoints=None, page_lines=PAGE_SIZE):
+    """`(section, first line number, numbered line count)` for every top-level
+    section, from one pass that counts lines without formatting them.
+
+    If `checkpoints` is a list, it gets one list per section of the
+    checkpoints its pages of `page_lines` lines start from, for
+    `render_section_page`.
+    """
+    sections = []
+    line_counter = [1]
+    for section in structured_root["children"]:
+        first_line = line_counter[0]
+        section_checkpoints = [] if checkpoints is not None else None
+        for _ in iter_node_lines([section], line_counter, checkpoints=section_checkpoints, page_lines=page_lines):
+            pass
+        sections.append((section, first_line, line_counter[0] - first_line))
+        if checkpoints is not None:
+            checkpoints.append(section_checkpoints)
+    return sections
+
+
+def render_section_page(section, first_line, page, page_lines, max_depth=None, checkpoints=None):
+    """Lines of one page of a section, as `index_sections` numbered it.
+
+    Page `page` holds line numbers `first_line + page * page_lines` up to the
+    next page, plus the unnumbered lines that follow them. Nodes more than
+    `max_depth` levels below the section are left out and their parent is
+    marked with "[+]"; line numbers stay those of the full text. Only the
+    lines of this page are formatted. Given the section's `checkpoints`
+    from `index_sections` (with the same `page_lines`), the walk starts at
+    the page instead of at the top of the section.
+    """
+    start = first_line + page * page_lines
+    end = start + page_lines
+    base_depth = section["depth"]
+    if checkpoints and page < len(checkpoints):
+        current = start
+        node_lines = resume_node_lines(checkpoints[page])
+    else:
+        current = first_line
+        node_lines = iter_node_lines([section], [first_line])
+    lines = []
+    for line_number, depth, node in node_lines:
+        if line_number is not None:
+            if line_number >= end:
+                break
+            current = line_number
+        if current < start:
+            continue
+        if max_depth is not None and depth - base_depth >= max_depth:
+            if depth - base_depth > max_depth:
+                continue
+            if node["children"]:
+                lines.append(format_line(line_number, depth, node) + " [+]")
+                continue
+        lines.append(format_line(line_number, depth, node))
+    return lines
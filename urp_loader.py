@@ -0,0 +1,100 @@
+import gzip
+from time import perf_counter
+
+from lxml import etree
+
+START_TAG = b"<URProgram"
+END_TAG = b"</URProgram>"
+CHUNK_SIZE = 1 << 20
+
+
+def load_urprogram(source, chunk_size=CHUNK_SIZE, profile=None, errors=None):
+    """Stream a gzip'd .urp straight into lxml and return the <URProgram> element.
+
+    `source` is a path or a binary file object. Decompressed chunks are fed to
+    an incremental recovering parser starting at the first `<URProgram` and
+    stopping after the first `</URProgram>`, so the program is never held as a
+    whole bytes/str copy. Returns None if the block cannot be found.
+
+    A `diagnostics.Profile` passed as `profile` gets the time spent
+    decompressing and parsing and the number of decompressed bytes. A list
+    passed as `errors` gets a "line L, column C: message" entry for every
+    error the recovering parser repaired or skipped; lines count from
+    `<URProgram`.
+    """
+    # huge_tree raises libxml2's nesting limit from 256 to 2048 elements,
+    # i.e. roughly 1000 levels of nested program nodes
+    parser = etree.XMLParser(recover=True, huge_tree=True)
+    with gzip.open(source, "rb") as stream:
+        if profile is None:
+            root = _feed_program(stream, parser, chunk_size)
+        else:
+            root = _feed_program(_TimedReader(stream, profile), _TimedParser(parser, profile), chunk_size)
+    if errors is not None:
+        errors.extend(f"line {error.line}, column {error.column}: {error.message}" for error in parser.feed_error_log)
+    return root
+
+
+def _feed_program(stream, parser, chunk_size):
+    started = False
+    # Bytes carried over between chunks so a tag split across a chunk
+    # boundary is still found.
+    carry = b""
+
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return None
+
+        if not started:
+            window = carry + chunk
+            start_index = window.find(START_TAG)
+            if start_index == -1:
+                carry = window[-(len(START_TAG) - 1):]
+                continue
+            started = True
+            chunk = window[start_index:]
+            carry = b""
+
+        window = carry + chunk
+        end_index = window.find(END_TAG)
+        if end_index != -1:
+            parser.feed(chunk[:end_index + len(END_TAG) - len(carry)])
+            return parser.close()
+
+        parser.feed(chunk)
+        carry = window[-(len(END_TAG) - 1):]
+
+
+class _TimedReader:
+    """Binary stream wrapper adding the time spent in read() to a profile."""
+
+    def __init__(self, stream, profile):
+        self._stream = stream
+        self._profile = profile
+
+    def read(self, size=-1):
+        started = perf_counter()
+        data = self._stream.read(size)
+        self._profile.add_time("decompress", perf_counter() - started)
+        self._profile.count("decompressed_bytes", len(data))
+        return data
+
+
+class _TimedParser:
+    """XMLParser wrapper adding the time spent in feed() and close() to a profile."""
+
+    def __init__(self, parser, profile):
+        self._parser = parser
+        self._profile = profile
+
+    def feed(self, data):
+        started = perf_counter()
+        self._parser.feed(data)
+        self._profile.add_time("xml_parse", perf_counter() - started)
+
+    def close(self):
+        started = perf_counter()
+        result = self._parser.close()
+        self._profile.add_time("xml_parse", perf_counter() - started)
+        return result
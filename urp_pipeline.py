@@ -0,0 +1,166 @@
+"""Convert .urp robot programs from Python, without the Streamlit app.
+
+    import urp_pipeline
+
+    tree = urp_pipeline.parse_program("backups/cell_3.urp")
+    print(urp_pipeline.render_text(tree))
+    xml = urp_pipeline.export_drawio(tree, compressed=True)
+
+Importing this module has no side effects and imports nothing beyond the
+standard library: lxml and the parser, renderer and exporter modules are
+imported on first use, so tools only pay for the steps they run.
+"""
+
+FORMATS = ("text", "drawio", "dot", "mermaid", "svg", "json", "tree")
+
+
+def load_program(source, profile=None):
+    """The <URProgram> element of a gzip'd .urp path or binary file object.
+
+    Raises ValueError if the file holds no <URProgram> block.
+    """
+    from urp_loader import load_urprogram
+
+    root = load_urprogram(source, profile=profile)
+    if root is None:
+        raise ValueError("Could not find <URProgram> block in the file.")
+    return root
+
+
+def parse_program(source, profile=None, index=None, analysis=None):
+    """Parsed ProgramNode tree of a .urp path or file object, or of an
+    already loaded <URProgram> element.
+
+    `profile`, `index` and `analysis` are passed on to
+    `expression_parser.parse_node_structured`.
+    """
+    from expression_parser import parse_node_structured
+
+    root = source if hasattr(source, "tag") else load_program(source, profile)
+    return parse_node_structured(root, root, profile=profile, index=index, analysis=analysis)
+
+
+def convert_program(root, profile=None):
+    """Parse a loaded <URProgram> element into the result dict the app
+    caches: the tree, its section offsets and page checkpoints, search index
+    and call graph analysis, and empty slots for the exports."""
+    from diagnostics import stage
+    from expression_parser import parse_node_structured
+    from program_analysis import ProgramAnalysis
+    from program_index import ProgramIndex
+    from text_renderer import index_sections
+
+    index = ProgramIndex()
+    analysis = ProgramAnalysis()
+    with stage(profile, "parse_structured"):
+        structured_root = parse_node_structured(root, root, profile=profile, index=index, analysis=analysis)
+    page_checkpoints = []
+    with stage(profile, "index_sections"):
+        sections = index_sections(structured_root, page_checkpoints)
+    return {
+        "structured_root": structured_root,
+        "sections": sections,
+        "page_checkpoints": page_checkpoints,
+        "index": index,
+        "analysis": analysis,
+        "text": None,
+        "drawio": None,
+        "drawio_overview": None,
+        "svg_overview": None,
+        "profile": None,
+        "stats": None,
+    }
+
+
+def convert_upload(data):
+    """Result dict of `convert_program` for the bytes of a .urp file, with
+    the text and compressed draw.io exports filled in and a "stats" entry:
+    node count, parse and export seconds, and the errors the recovering
+    XML parser repaired or skipped.
+
+    Module-level and self-contained so it can run on a process pool.
+    Raises ValueError if the file holds no <URProgram> block.
+    """
+    import io
+    import time
+
+    from drawio_exporter import generate_drawio_xml
+    from text_renderer import render_program_text
+    from urp_loader import load_urprogram
+
+    started = time.perf_counter()
+    errors = []
+    root = load_urprogram(io.BytesIO(data), errors=errors)
+    if root is None:
+        raise ValueError("Could not find <URProgram> block in the file.")
+    result = convert_program(root)
+    parsed = time.perf_counter()
+    result["text"] = render_program_text(result["structured_root"])
+    result["drawio"] = generate_drawio_xml(result["structured_root"], compressed=True, analysis=result["analysis"])
+    result["stats"] = {
+        "nodes": len(result["index"].nodes),
+        "parse_seconds": parsed - started,
+        "export_seconds": time.perf_counter() - parsed,
+        "parser_errors": errors,
+    }
+    return result
+
+
+def render_lines(tree):
+    """The numbered text lines of a parsed program, as in the text export."""
+    from text_renderer import render_node_list
+
+    return render_node_list(tree["children"])
+
+
+def render_text(tree):
+    from text_renderer import render_program_text
+
+    return render_program_text(tree)
+
+
+def export_drawio(tree, compressed=False, analysis=None, detail=None, pages=False):
+    """draw.io document of a parsed program; with `pages`, one page per
+    top-level section. See `drawio_exporter.generate_drawio_xml`."""
+    from drawio_exporter import generate_drawio_pages, generate_drawio_xml
+
+    if pages:
+        return generate_drawio_pages(tree, compressed, analysis, detail=detail)
+    return generate_drawio_xml(tree, compressed, analysis, detail=detail)
+
+
+def export_diagrams(tree, formats, detail=None, compressed=False, analysis=None):
+    """{format: document} for several of "drawio", "dot", "mermaid" and
+    "svg", laid out once. See `diagram_emitters.export_diagrams`."""
+    from diagram_emitters import export_diagrams
+
+    return export_diagrams(tree, formats, detail, compressed, analysis)
+
+
+def convert(source, formats=("text",), **diagram_options):
+    """Parse `source` once and export it to each of `formats`.
+
+    Returns {format: output}; outputs are str, except "tree" (the binary
+    tree format, bytes). Diagram formats share one layout and get
+    `diagram_options` (`detail`, `compressed`, `analysis`).
+    """
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError(f"unknown formats: {', '.join(sorted(unknown))}")
+    tree = parse_program(source)
+    diagram_formats = [fmt for fmt in formats if fmt in ("drawio", "dot", "mermaid", "svg")]
+    outputs = export_diagrams(tree, diagram_formats, **diagram_options) if diagram_formats else {}
+    for fmt in formats:
+        if fmt == "text":
+            outputs[fmt] = render_text(tree)
+        elif fmt in outputs:
+            continue
+        elif fmt == "json":
+            import json
+
+            outputs[fmt] = json.dumps(tree.to_dict())
+        else:
+            from program_store import dump_program_tree
+
+            outputs[fmt] = dump_program_tree(tree)
+    return outputs
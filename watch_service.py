@@ -0,0 +1,389 @@
+"""Keep converted copies of a directory tree of .urp files up to date.
+
+Example:
+    python watch_service.py backups/ -o converted/ --format text drawio --workers 4 --metrics-port 9108
+
+The directory is rescanned every `--interval` seconds. A manifest in the
+output directory records (mtime, size, SHA-256) of every input converted
+successfully, and a digest of the formats and options it was converted
+with, so only files whose content or settings changed are converted again;
+files touched without being changed are just hashed. Deleted inputs have
+their outputs removed. Failed conversions are retried once the file
+changes, or on the next start.
+"""
+import argparse
+import hashlib
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from batch_convert import OUTPUT_SUFFIXES, convert_file
+from layout import LevelOfDetail
+
+MANIFEST_NAME = ".urp-manifest.json"
+METRICS_NAME = "metrics.json"
+# Completed conversions the latency percentiles are computed over
+LATENCY_WINDOW = 1000
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_digest(path):
+    """SHA-256 hex digest of a file's content, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan_inputs(input_dir):
+    """{relative path: (mtime_ns, size)} of the .urp files under `input_dir`."""
+    found = {}
+    stack = [input_dir]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue  # removed or unreadable since it was listed
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.name.lower().endswith(".urp"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                found[os.path.relpath(entry.path, input_dir)] = (stat.st_mtime_ns, stat.st_size)
+    return found
+
+
+def settings_digest(formats, convert_options):
+    """Short digest of the output formats and conversion options, stored
+    with each manifest entry so changing them converts everything again."""
+    settings = {"formats": sorted(formats), "options": {name: repr(value) for name, value in sorted(convert_options.items())}}
+    return hashlib.sha256(json.dumps(settings).encode("utf-8")).hexdigest()[:16]
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        "p50": ordered[len(ordered) // 2],
+        "p95": ordered[min(len(ordered) - 1, len(ordered) * 95 // 100)],
+        "max": ordered[-1],
+    }
+
+
+class WatchService:
+    """Converts the .urp files under `input_dir` whenever their content changes.
+
+    Changed files wait `debounce` seconds after their last modification, so
+    a file still being synced is converted once it is complete. Up to
+    `queue_size` files wait in the queue; further changes are picked up by
+    later scans. `workers` processes convert the queued files with
+    `batch_convert.convert_file`, which receives `convert_options`.
+    """
+
+    def __init__(self, input_dir, output_dir, formats, workers=None, queue_size=256, debounce=2.0, interval=5.0, **convert_options):
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.formats = formats
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.debounce = debounce
+        self.interval = interval
+        self.convert_options = convert_options
+        self.settings = settings_digest(formats, convert_options)
+        self.manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        self.manifest = self._load_manifest()
+        self._manifest_dirty = False
+
+        self.queue = OrderedDict()  # relative path -> (mtime_ns, size, digest)
+        self.in_flight = {}  # future -> (relative path, mtime_ns, size, digest)
+        self.failures = {}  # relative path -> (mtime_ns, size) of its last failed conversion
+        self.crashed = set()  # relative paths whose worker died once
+        self.settling = 0  # changed files still within the debounce period
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.conversion_seconds = deque(maxlen=LATENCY_WINDOW)
+        self.counters = {"scans": 0, "converted": 0, "failed": 0, "unchanged": 0, "removed": 0}
+        self.last_scan_seconds = None
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def scan(self):
+        """Queue the files whose content changed since they were converted;
+        returns how many were queued."""
+        started = time.perf_counter()
+        now_ns = time.time_ns()
+        found = scan_inputs(self.input_dir)
+        busy = set(self.queue) | {rel for rel, *_ in self.in_flight.values()}
+        queued = 0
+        settling = 0
+
+        for rel, (mtime_ns, size) in found.items():
+            entry = self.manifest.get(rel)
+            if entry is not None and entry.get("settings") != self.settings:
+                entry = None  # converted with other formats or options
+            if entry is not None and entry["mtime_ns"] == mtime_ns and entry["size"] == size:
+                continue
+            if rel in busy or self.failures.get(rel) == (mtime_ns, size):
+                continue
+            if now_ns - mtime_ns < self.debounce * 1e9:
+                settling += 1
+                continue
+            if len(self.queue) >= self.queue_size:
+                continue
+            try:
+                digest = file_digest(os.path.join(self.input_dir, rel))
+            except OSError:
+                continue
+            if entry is not None and entry["sha256"] == digest:
+                # Touched (or copied over) without changing
+                entry["mtime_ns"], entry["size"] = mtime_ns, size
+                self._manifest_dirty = True
+                self.counters["unchanged"] += 1
+                continue
+            self.queue[rel] = (mtime_ns, size, digest)
+            queued += 1
+
+        for rel in [rel for rel in self.failures if rel not in found]:
+            del self.failures[rel]
+        for rel in [rel for rel in self.manifest if rel not in found and rel not in busy]:
+            self._remove_outputs(self.manifest.pop(rel))
+            self._manifest_dirty = True
+            self.counters["removed"] += 1
+
+        with self._lock:
+            self.settling = settling
+            self.counters["scans"] += 1
+            self.last_scan_seconds = time.perf_counter() - started
+        return queued
+
+    def dispatch(self):
+        """Hand queued files to the pool, keeping at most one per worker in
+        flight so the queue stays the only backlog."""
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        while self.queue and len(self.in_flight) < self.workers:
+            rel, (mtime_ns, size, digest) = self.queue.popitem(last=False)
+            output_base = os.path.join(self.output_dir, os.path.splitext(rel)[0])
+            args = (convert_file, os.path.join(self.input_dir, rel), output_base, self.formats)
+            try:
+                future = self._pool.submit(*args, **self.convert_options)
+            except BrokenProcessPool:
+                # A worker died outright earlier; carry on with a fresh pool
+                self._pool.shutdown(wait=False)
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                future = self._pool.submit(*args, **self.convert_options)
+            self.in_flight[future] = (rel, mtime_ns, size, digest)
+
+    def collect(self, timeout=0):
+        """Record the conversions finishing within `timeout` seconds; returns
+        their results."""
+        if not self.in_flight:
+            return []
+        done, _ = wait(self.in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+        results = []
+        for future in done:
+            rel, mtime_ns, size, digest = self.in_flight.pop(future)
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                # A worker died outright (e.g. out of memory), failing every
+                # file in flight; dispatch() replaces the pool. A file is
+                # left for the next scan the first time, and only fails if
+                # its worker dies again.
+                if rel not in self.crashed:
+                    self.crashed.add(rel)
+                    continue
+                result = {"path": rel, "ok": False, "error": f"worker crashed: {e}", "outputs": [], "seconds": 0.0}
+            self.crashed.discard(rel)
+            if result["ok"]:
+                self.failures.pop(rel, None)
+                previous = self.manifest.get(rel)
+                if previous is not None:
+                    self._remove_outputs(previous, keep=result["outputs"])
+                self.manifest[rel] = {
+                    "mtime_ns": mtime_ns,
+                    "size": size,
+                    "sha256": digest,
+                    "settings": self.settings,
+                    "outputs": result["outputs"],
+                }
+                self._manifest_dirty = True
+            else:
+                # Not recorded, so it is converted again once it changes
+                # (or on the next start); the previous outputs stay
+                self.failures[rel] = (mtime_ns, size)
+            with self._lock:
+                self.counters["converted" if result["ok"] else "failed"] += 1
+                self.latencies.append(time.time() - mtime_ns / 1e9)
+                self.conversion_seconds.append(result["seconds"])
+            results.append(result)
+        return results
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "queue_depth": len(self.queue),
+                "in_flight": len(self.in_flight),
+                "settling": self.settling,
+                "files_tracked": len(self.manifest),
+                "files_failing": len(self.failures),
+                "last_scan_seconds": self.last_scan_seconds,
+                # From the file's last modification to its outputs being written
+                "latency_seconds": _percentiles(self.latencies),
+                "conversion_seconds": _percentiles(self.conversion_seconds),
+                **self.counters,
+            }
+
+    def run(self, stop=None, once=False, progress=None):
+        """Scan, convert and repeat every `interval` seconds until `stop` (a
+        threading.Event) is set. With `once`, returns after one scan's files
+        are converted. `progress(result)` is called for every conversion."""
+        stop = stop or threading.Event()
+        try:
+            while not stop.is_set():
+                next_scan = time.monotonic() + self.interval
+                queued = self.scan()
+                self.dispatch()
+                while self.in_flight and not stop.is_set():
+                    timeout = None if once else next_scan - time.monotonic()
+                    if timeout is not None and timeout <= 0:
+                        break  # rescan while the conversions go on
+                    for result in self.collect(timeout):
+                        if progress is not None:
+                            progress(result)
+                    self.dispatch()
+                self.save()
+                if once:
+                    # Rescan until files left out of a full queue are done too
+                    if not queued and not self.queue:
+                        break
+                    continue
+                stop.wait(max(0.0, next_scan - time.monotonic()))
+        finally:
+            self.close()
+
+    def save(self):
+        """Write the manifest (if it changed) and the metrics file."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self._manifest_dirty:
+            self._write_json(self.manifest_path, self.manifest)
+            self._manifest_dirty = False
+        self._write_json(os.path.join(self.output_dir, METRICS_NAME), self.metrics())
+
+    def close(self):
+        self.save()
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _remove_outputs(entry, keep=()):
+        for path in entry.get("outputs", ()):
+            if path not in keep:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _write_json(path, data):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+
+def serve_metrics(service, port):
+    """Serve `service.metrics()` as JSON over HTTP on `port`, from a daemon thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(service.metrics()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Watch a directory of .urp robot programs and keep their conversions current.")
+    parser.add_argument("input_dir", help="Directory to watch (searched recursively)")
+    parser.add_argument("-o", "--output-dir", default="converted", help="Directory for the converted files, the manifest and metrics.json")
+    parser.add_argument("-f", "--format", nargs="+", choices=sorted(OUTPUT_SUFFIXES), default=["text"], help="Output formats")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("-t", "--timeout", type=float, default=None, help="Per-file timeout in seconds")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between two scans of the directory")
+    parser.add_argument("--debounce", type=float, default=2.0, help="Seconds a file must go unmodified before it is converted")
+    parser.add_argument("--queue-size", type=int, default=256, help="Most files waiting for a worker; further changes wait for a later scan")
+    parser.add_argument("--compress-drawio", action="store_true", help="Write draw.io diagrams in draw.io's compressed format")
+    parser.add_argument("--max-depth", type=int, default=None, help="Draw at most this many levels below each section; deeper nodes are folded into summary cells")
+    parser.add_argument("--max-children", type=int, default=None, help="Draw at most this many children per node; the rest are folded into a summary cell")
+    parser.add_argument("--collapse-runs", action="store_true", help="Fold runs of Move/Waypoint and InitVariable nodes into summary cells")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Serve the queue and latency metrics as JSON on this HTTP port")
+    parser.add_argument("--once", action="store_true", help="Convert what changed since the last run and exit")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only print failures")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.input_dir):
+        print(f"Not a directory: {args.input_dir}", file=sys.stderr)
+        return 1
+
+    detail = None
+    if args.max_depth is not None or args.max_children is not None or args.collapse_runs:
+        detail = LevelOfDetail(args.max_depth, args.max_children, args.collapse_runs)
+    service = WatchService(
+        args.input_dir, args.output_dir, args.format, args.workers, args.queue_size, args.debounce, args.interval,
+        timeout=args.timeout, compress_drawio=args.compress_drawio, drawio_detail=detail,
+    )
+    if args.metrics_port is not None:
+        serve_metrics(service, args.metrics_port)
+
+    def progress(result):
+        if not result["ok"]:
+            print(f"FAILED {result['path']}: {result['error']}", file=sys.stderr)
+        elif not args.quiet:
+            print(f"ok     {result['path']} ({result['seconds']:.2f}s)")
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    try:
+        service.run(stop, once=args.once, progress=progress)
+    except KeyboardInterrupt:
+        pass
+    metrics = service.metrics()
+    print(
+        f"{metrics['files_tracked']} files tracked, {metrics['converted']} converted, "
+        f"{metrics['failed']} failed, {metrics['unchanged']} unchanged"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())